@@ -0,0 +1,266 @@
+### bundle.py --- Portable cache bundles
+
+## Copyright (C) 2006 Brailcom, o.p.s.
+##
+## Author: Milan Zamazal <pdm@brailcom.org>
+##
+## COPYRIGHT NOTICE
+##
+## This program is free software; you can redistribute it and/or modify it
+## under the terms of the GNU General Public License as published by the Free
+## Software Foundation; either version 2 of the License, or (at your option)
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+## more details.
+##
+## You should have received a copy of the GNU General Public License along with
+## this program; if not, write to the Free Software Foundation, Inc., 51
+## Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import getopt
+import os
+import StringIO
+import sys
+import tarfile
+import time
+import urlparse
+
+from charseq import str
+import cache
+import exception
+
+
+# A bundle is a gzip compressed tar archive containing a subset of the page
+# cache.  Unlike the cache directory, it doesn't depend on the cache backend
+# and it can be moved to other machines and imported into their caches, e.g. to
+# retrieve pages on one machine and to check them on several other machines.
+#
+# The archive contains the file 'manifest' and a directory for each of the
+# entries.  The first line of the manifest identifies the bundle format, each
+# of the following lines describes a single entry by the name of its
+# directory, the time when its metadata were stored and its URL, separated by
+# tab characters.  The entry directory contains the file 'content' with the
+# page copy, if the copy is present, and files named by the cache metadata
+# keys containing the metadata items.
+
+_FORMAT = 'WAchecker cache bundle 1'
+_MANIFEST = 'manifest'
+_CONTENT = 'content'
+# Entry times differing less than this number of seconds are considered equal,
+# file systems needn't store modification times exactly
+_TIME_PRECISION = 0.001
+
+MERGE_MODES = ('newer', 'replace', 'keep',)
+"""Ways of handling entries present both in the imported bundle and the cache.
+'newer' -- use the entry stored later, 'replace' -- always use the bundle entry,
+'keep' -- always keep the cache entry.
+"""
+
+def _site (url):
+    host = urlparse.urlparse (url)[1].lower ()
+    if '@' in host:
+        host = host.split ('@', 1)[1]
+    return host.split (':', 1)[0]
+
+def _entry_time (cache_, url):
+    times = [t for t in [cache_.modification_time (url, k) for k in cache.METADATA_KEYS]
+             if t is not None]
+    if not times:
+        return None
+    return max (times)
+
+def _add_string (archive, name, data, mtime):
+    info = tarfile.TarInfo (name)
+    info.size = len (data)
+    info.mtime = mtime
+    archive.addfile (info, StringIO.StringIO (data))
+
+def export_bundle (file_name, urls=None, sites=None, cache_=None):
+    """Write cache entries to bundle 'file_name'.
+    'urls' is a sequence of URLs of the entries to export, if it is None, all
+    the entries with known URLs are exported.  If 'sites' is not None, only
+    entries of the URLs whose host names are present in the 'sites' sequence are
+    exported.
+    'cache_' is the 'cache.Cache' instance to export from, if it is None, the
+    configured cache is used.
+    Return the number of exported entries.
+    """
+    if cache_ is None:
+        cache_ = cache.cache ()
+    if urls is None:
+        urls = cache_.urls ()
+    if sites is not None:
+        sites = [s.lower () for s in sites]
+        urls = [u for u in urls if _site (u) in sites]
+    now = time.time ()
+    manifest = [_FORMAT]
+    try:
+        archive = tarfile.open (file_name, 'w:gz')
+        try:
+            for url in urls:
+                url = str (url)
+                if '\t' in url or '\n' in url:
+                    continue
+                lock = cache_.lock (url, exclusive=False)
+                try:
+                    metadata = {}
+                    for k in cache.METADATA_KEYS:
+                        value = cache_.get (url, k)
+                        if value is not None:
+                            metadata[k] = value
+                    entry_time = _entry_time (cache_, url)
+                    try:
+                        stream = open (cache_.content_file_name (url), 'rb')
+                    except IOError:
+                        stream = None
+                    if not metadata and stream is None:
+                        continue
+                    directory = '%d' % (len (manifest),)
+                    # Members are stored in the order in which they are read
+                    # on import, so that the compressed archive needn't be
+                    # read repeatedly
+                    for k in cache.METADATA_KEYS:
+                        if metadata.has_key (k):
+                            _add_string (archive, '%s/%s' % (directory, k,), metadata[k], now)
+                    if stream is not None:
+                        try:
+                            info = archive.gettarinfo (arcname='%s/%s' % (directory, _CONTENT,),
+                                                       fileobj=stream)
+                            archive.addfile (info, stream)
+                        finally:
+                            stream.close ()
+                finally:
+                    lock.release ()
+                manifest.append ('%s\t%f\t%s' % (directory, entry_time or now, url,))
+            _add_string (archive, _MANIFEST, '\n'.join (manifest) + '\n', now)
+        finally:
+            archive.close ()
+    except (IOError, OSError, tarfile.TarError), e:
+        raise exception.System_Error ("Bundle could not be written", e)
+    return len (manifest) - 1
+
+def _read_member (archive, name):
+    try:
+        member = archive.getmember (name)
+    except KeyError:
+        return None
+    f = archive.extractfile (member)
+    try:
+        return f.read ()
+    finally:
+        f.close ()
+
+def import_bundle (file_name, merge='newer', cache_=None):
+    """Store cache entries from bundle 'file_name' to the cache.
+    'merge' is one of 'MERGE_MODES' and determines what happens with entries
+    already present in the cache.
+    'cache_' is the 'cache.Cache' instance to import to, if it is None, the
+    configured cache is used.
+    Return pair (IMPORTED, SKIPPED,) containing the numbers of imported entries
+    and of entries not imported because of the 'merge' mode.
+    """
+    assert merge in MERGE_MODES, merge
+    if cache_ is None:
+        cache_ = cache.cache ()
+    imported = skipped = 0
+    try:
+        archive = tarfile.open (file_name, 'r:gz')
+        try:
+            manifest = _read_member (archive, _MANIFEST)
+            if manifest is None:
+                raise exception.System_Error ("Invalid bundle", None, file_name)
+            lines = manifest.splitlines ()
+            if not lines or lines[0] != _FORMAT:
+                raise exception.System_Error ("Unsupported bundle format", None, file_name)
+            for line in lines[1:]:
+                directory, entry_time, url = line.split ('\t', 2)
+                entry_time = float (entry_time)
+                existing_time = _entry_time (cache_, url)
+                if existing_time is not None and (merge == 'keep' or
+                                                  (merge == 'newer' and
+                                                   existing_time > entry_time - _TIME_PRECISION)):
+                    skipped = skipped + 1
+                    continue
+                metadata = {}
+                for k in cache.METADATA_KEYS:
+                    value = _read_member (archive, '%s/%s' % (directory, k,))
+                    if value is not None:
+                        metadata[k] = value
+                try:
+                    member = archive.getmember ('%s/%s' % (directory, _CONTENT,))
+                except KeyError:
+                    member = None
+                if member is None:
+                    cache_.update (url, metadata, stored_time=entry_time)
+                else:
+                    temporary_file_name = cache_.temporary_file_name (url)
+                    try:
+                        source = archive.extractfile (member)
+                        try:
+                            f = open (temporary_file_name, 'wb')
+                            try:
+                                while True:
+                                    data = source.read (65536)
+                                    if not data:
+                                        break
+                                    f.write (data)
+                            finally:
+                                f.close ()
+                        finally:
+                            source.close ()
+                        cache_.commit_content (url, temporary_file_name, metadata,
+                                               stored_time=entry_time)
+                    finally:
+                        if os.path.exists (temporary_file_name):
+                            os.remove (temporary_file_name)
+                imported = imported + 1
+        finally:
+            archive.close ()
+    except (IOError, OSError, ValueError, tarfile.TarError), e:
+        raise exception.System_Error ("Bundle could not be read", e)
+    return imported, skipped
+
+
+_USAGE = """Usage: python -m wachecker.bundle export [--site=HOST ...] FILE [URL ...]
+       python -m wachecker.bundle import [--merge=newer|replace|keep] FILE
+"""
+
+def main (arguments):
+    """Export or import bundle as requested by command line 'arguments'.
+    """
+    if not arguments or arguments[0] not in ('export', 'import',):
+        sys.stderr.write (_USAGE)
+        return 1
+    command = arguments[0]
+    try:
+        options, arguments = getopt.getopt (arguments[1:], '', ('site=', 'merge=',))
+    except getopt.GetoptError, e:
+        sys.stderr.write ('%s\n%s' % (e, _USAGE,))
+        return 1
+    sites = None
+    merge = 'newer'
+    for option, value in options:
+        if option == '--site':
+            sites = (sites or []) + [value]
+        elif option == '--merge':
+            merge = value
+    if not arguments or merge not in MERGE_MODES:
+        sys.stderr.write (_USAGE)
+        return 1
+    file_name = arguments[0]
+    if command == 'export':
+        urls = arguments[1:] or None
+        n = export_bundle (file_name, urls=urls, sites=sites)
+        print 'Exported entries: %d' % (n,)
+    else:
+        imported, skipped = import_bundle (file_name, merge=merge)
+        print 'Imported entries: %d' % (imported,)
+        print 'Skipped entries: %d' % (skipped,)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit (main (sys.argv[1:]))
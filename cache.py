@@ -0,0 +1,828 @@
+### cache.py --- Storage of cached Web pages
+
+## Copyright (C) 2006 Brailcom, o.p.s.
+##
+## Author: Milan Zamazal <pdm@brailcom.org>
+##
+## COPYRIGHT NOTICE
+##
+## This program is free software; you can redistribute it and/or modify it
+## under the terms of the GNU General Public License as published by the Free
+## Software Foundation; either version 2 of the License, or (at your option)
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+## more details.
+##
+## You should have received a copy of the GNU General Public License along with
+## this program; if not, write to the Free Software Foundation, Inc., 51
+## Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+try:
+    import fcntl
+except ImportError:
+    # Locking not available, the cache may be used only by a single process
+    fcntl = None
+import md5
+import os
+import re
+try:
+    import sqlite3
+except ImportError:
+    # Python older than 2.5, only the flat cache is available
+    sqlite3 = None
+import tempfile
+import threading
+import time
+
+from charseq import str
+import config
+import exception
+import util
+
+
+METADATA_KEYS = ('charset', 'mime_type', 'headers', 'encoding', 'truncated',)
+"""Names of the metadata items stored with each cached page.
+"""
+
+# The umask can be read only by setting it, do it once at import time rather
+# than on each write, when other threads may be creating files
+_UMASK = os.umask (0)
+os.umask (_UMASK)
+
+
+class Statistics (util.Structure):
+    """Cache usage statistics.
+    """
+    _attributes = (('entries', "Number of cache entries",),
+                   ('size', "Total size of the cached data in bytes",),
+                   )
+
+
+class _Entry (util.Structure):
+    _attributes = (('hash', "MD5 hash of the entry URL",),
+                   ('last_use', "Time of the last use of the entry",),
+                   ('size', "Size of the entry data in bytes",),
+                   )
+
+
+class _Lock (object):
+    """Lock of a cache entry shared by all processes using the cache.
+    """
+
+    def __init__ (self, file_name, exclusive):
+        self._file = open (file_name, 'a')
+        if fcntl is not None:
+            if exclusive:
+                operation = fcntl.LOCK_EX
+            else:
+                operation = fcntl.LOCK_SH
+            fcntl.flock (self._file.fileno (), operation)
+
+    def release (self):
+        """Release the lock.
+        """
+        if self._file is not None:
+            if fcntl is not None:
+                fcntl.flock (self._file.fileno (), fcntl.LOCK_UN)
+            self._file.close ()
+            self._file = None
+
+            
+class Cache (object):
+    """Storage of page copies and their metadata.
+    Each cache entry is identified by URL and consists of the page contents
+    stored in a file and of metadata items named by 'METADATA_KEYS'.  Metadata
+    values are strings.
+    This is an abstract class, subclasses implement particular storage
+    layouts.
+    The cache size can be limited by 'config.cache_size_limit' and
+    'config.cache_entries_limit'.  When the limits are exceeded, least recently
+    used entries are removed.  The limits are checked against running totals
+    of the cache size, which are computed once and then updated on each change;
+    changes made by other processes are counted only after 'compact'.
+    Several processes may use the same cache simultaneously.  Entry changes are
+    protected by entry locks, page copies are written to temporary files
+    renamed to their final names when complete.
+    """
+
+    # When the limits are exceeded, entries are removed until this part of the
+    # limits is free, so that the cache needn't be listed on each commit
+    _eviction_margin = 0.1
+    _temporary_file_prefix = '.tmp-'
+    _stale_temporary_file_age = 3600
+    _lock_directory_name = '.locks'
+    # Number of lock files, each of the lock files is shared by several cache
+    # entries
+    _lock_stripes = 256
+
+    def __init__ (self, directory):
+        """'directory' is the name of the directory where the cache is stored.
+        """
+        self._directory = directory
+        self._totals = None
+        self._totals_lock = threading.Lock ()
+
+    def _hash (self, url):
+        return md5.new (str (url)).hexdigest ()
+
+    def _ensure_directory (self, directory):
+        if not os.path.isdir (directory):
+            try:
+                os.makedirs (directory)
+            except OSError, e:
+                if not os.path.isdir (directory):
+                    raise exception.System_Error ("Write to local disk failed", e)
+
+    def _lock (self, hash_, exclusive):
+        directory = os.path.join (self._directory, self._lock_directory_name)
+        self._ensure_directory (directory)
+        stripe = int (hash_[:4], 16) % self._lock_stripes
+        try:
+            return _Lock (os.path.join (directory, '%02x' % (stripe,)), exclusive)
+        except IOError, e:
+            raise exception.System_Error ("Cache entry locking failed", e)
+        
+    def lock (self, url, exclusive=True):
+        """Lock cache entry of 'url' and return the lock.
+        If 'exclusive' is true, no other lock of the entry may be held at the
+        same time, otherwise the lock may be shared with other non-exclusive
+        locks.  The caller must call the 'release' method of the returned
+        object to unlock the entry.  While holding a lock, no other cache
+        methods may be called.
+        """
+        return self._lock (self._hash (url), exclusive)
+    
+    def directory (self):
+        """Return the name of the cache directory.
+        """
+        return self._directory
+
+    def content_file_name (self, url):
+        """Return name of the file containing the cached copy of 'url'.
+        The file need not exist, but it must be located in a directory where
+        'temporary_file_name' can create files to be renamed to it.
+        Backends must implement this method.
+        """
+        raise NotImplementedError
+
+    def has_content (self, url):
+        """Return true iff the cache contains a copy of 'url'.
+        """
+        return os.path.exists (self.content_file_name (url))
+
+    def temporary_file_name (self, url):
+        """Return name of a new file to store contents of 'url' to.
+        The file is made the cached copy of 'url' by calling 'commit_content'.
+        If it is not used, the caller is responsible for removing it.
+        """
+        file_name = self.content_file_name (url)
+        directory = os.path.dirname (file_name)
+        self._ensure_directory (directory)
+        fd, temporary_name = self._make_temporary_file (directory)
+        os.close (fd)
+        return temporary_name
+
+    def _make_temporary_file (self, directory):
+        fd, temporary_name = tempfile.mkstemp (prefix=self._temporary_file_prefix, dir=directory)
+        # mkstemp makes the file accessible only to its owner, use the usual
+        # permissions instead
+        os.chmod (temporary_name, 0666 & ~_UMASK)
+        return fd, temporary_name
+
+    def commit_content (self, url, temporary_file_name, metadata={}, stored_time=None):
+        """Make 'temporary_file_name' the cached copy of 'url'.
+        'temporary_file_name' must be a name returned by 'temporary_file_name'.
+        'metadata' and 'stored_time' describe metadata items of the new copy as
+        in 'update'.
+        The cached copy and its metadata are replaced atomically, concurrent
+        readers using 'open_content' see either the old or the new contents and
+        metadata.
+        """
+        hash_ = self._hash (url)
+        lock = self.lock (url)
+        try:
+            old_size = self._entry_size (hash_)
+            self._commit_content (url, temporary_file_name)
+            if metadata:
+                self._update (url, metadata, stored_time)
+            self._update_totals (old_size, self._entry_size (hash_))
+        finally:
+            lock.release ()
+        self.enforce_limits (keep=(url,))
+
+    def _commit_content (self, url, temporary_file_name):
+        try:
+            os.rename (temporary_file_name, self.content_file_name (url))
+        except OSError, e:
+            raise exception.System_Error ("Write to local disk failed", e)
+
+    def open_content (self, url, keys=()):
+        """Open the cached copy of 'url' and return pair (STREAM, METADATA,).
+        STREAM is a binary file object of the copy, METADATA is a dictionary of
+        metadata items named in 'keys' corresponding to the copy.  Items not
+        present in the cache have None values.
+        If the cache doesn't contain a copy of 'url', raise 'IOError'.
+        """
+        lock = self.lock (url, exclusive=False)
+        try:
+            stream = open (self.content_file_name (url), 'rb')
+            metadata = {}
+            for k in keys:
+                metadata[k] = self.get (url, k)
+        finally:
+            lock.release ()
+        return stream, metadata
+        
+    def touch (self, url):
+        """Mark the cached copy of 'url' as just used.
+        The entry of 'url' then becomes the last candidate for eviction.  If
+        the cache doesn't contain 'url', do nothing.
+        Backends must implement this method.
+        """
+        raise NotImplementedError
+
+    def get (self, url, key):
+        """Return metadata item 'key' of 'url' or None if it is not stored.
+        The value is the string stored by 'update' or 'commit_content'.
+        Backends must implement this method.
+        """
+        raise NotImplementedError
+
+    def lookup (self, urls, key):
+        """Return dictionary of metadata items 'key' of all 'urls'.
+        Keys of the dictionary are the URLs, URLs without the metadata item
+        stored are not included.
+        """
+        result = {}
+        for url in urls:
+            value = self.get (url, key)
+            if value is not None:
+                result[url] = value
+        return result
+
+    def update (self, url, items, stored_time=None):
+        """Store metadata of 'url'.
+        'items' is a dictionary with metadata keys as keys and strings as
+        values.
+        'stored_time' is the time to be returned by 'modification_time' for
+        the items; if it is None, the current time is used.
+        """
+        hash_ = self._hash (url)
+        lock = self.lock (url)
+        try:
+            old_size = self._entry_size (hash_)
+            self._update (url, items, stored_time)
+            self._update_totals (old_size, self._entry_size (hash_))
+        finally:
+            lock.release ()
+        self.enforce_limits (keep=(url,))
+
+    def _update (self, url, items, stored_time):
+        # Store 'items' of 'url' as described in 'update', with the lock of
+        # 'url' already held.  Backends must implement this method.
+        raise NotImplementedError
+
+    def modification_time (self, url, key):
+        """Return time when metadata item 'key' of 'url' was last stored.
+        The time is the 'stored_time' given to 'update' or 'commit_content',
+        in seconds since the epoch.  If the item is not stored, return None.
+        Backends must implement this method.
+        """
+        raise NotImplementedError
+
+    def urls (self):
+        """Return sequence of URLs of all cache entries.
+        Entries stored by older WAchecker versions, which didn't record the
+        URLs, are not included.
+        Backends must implement this method.
+        """
+        raise NotImplementedError
+
+    def remove (self, url):
+        """Remove all data of 'url' from the cache.
+        """
+        self._remove_entry (self._hash (url))
+
+    def statistics (self):
+        """Return cache usage as a 'Statistics' instance.
+        """
+        entries = self._entries ()
+        size = 0
+        for e in entries:
+            size = size + e.size
+        return Statistics (entries=len (entries), size=size)
+
+    def _entries (self):
+        # Return sequence of '_Entry' instances of all cache entries, in any
+        # order.  Backends must implement this method.
+        raise NotImplementedError
+
+    def _entry_size (self, hash_):
+        # Return size of the entry as counted in '_entries' or None if the
+        # entry is not present.  Backends must implement this method.
+        raise NotImplementedError
+
+    def _current_statistics (self):
+        # Return 'Statistics' of the cache based on the running totals
+        self._totals_lock.acquire ()
+        try:
+            if self._totals is None:
+                self._totals = self.statistics ()
+            return Statistics (entries=self._totals.entries, size=self._totals.size)
+        finally:
+            self._totals_lock.release ()
+
+    def _update_totals (self, old_size, new_size):
+        # Update the running totals after an entry of 'old_size' was replaced
+        # by one of 'new_size', as returned by '_entry_size'
+        self._totals_lock.acquire ()
+        try:
+            totals = self._totals
+            if totals is not None:
+                totals.entries = totals.entries + (new_size is not None) - (old_size is not None)
+                totals.size = totals.size + (new_size or 0) - (old_size or 0)
+        finally:
+            self._totals_lock.release ()
+
+    def _reset_totals (self, statistics):
+        self._totals_lock.acquire ()
+        try:
+            self._totals = Statistics (entries=statistics.entries, size=statistics.size)
+        finally:
+            self._totals_lock.release ()
+
+    def _remove_entry (self, hash_):
+        lock = self._lock (hash_, True)
+        try:
+            old_size = self._entry_size (hash_)
+            self._delete_entry (hash_)
+            self._update_totals (old_size, None)
+        finally:
+            lock.release ()
+
+    def _delete_entry (self, hash_):
+        # Remove the cached copy and all metadata of the entry, with the lock
+        # of the entry already held.  Missing parts are ignored.  Backends must
+        # implement this method.
+        raise NotImplementedError
+
+    def evict (self, size_limit=None, entries_limit=None, keep=()):
+        """Remove least recently used entries until the cache fits the limits.
+        'size_limit' is the maximum total size of the cache in bytes,
+        'entries_limit' is the maximum number of cache entries.  None means no
+        limit.  Entries of URLs contained in 'keep' are never removed.
+        Entries are removed file by file, so processes reading the cache at
+        the same time either still read the whole old file or don't find the
+        file at all and fetch the page again.
+        Return 'Statistics' of the removed entries.
+        """
+        statistics = self._current_statistics ()
+        size = statistics.size
+        n_entries = statistics.entries
+        if ((size_limit is None or size <= size_limit) and
+            (entries_limit is None or n_entries <= entries_limit)):
+            return Statistics (entries=0, size=0)
+        entries = self._entries ()
+        kept_hashes = [self._hash (url) for url in keep]
+        entries = util.sort (list (entries), lambda e1, e2: cmp (e1.last_use, e2.last_use))
+        removed_entries = removed_size = 0
+        for e in entries:
+            if ((size_limit is None or size <= size_limit) and
+                (entries_limit is None or n_entries <= entries_limit)):
+                break
+            if e.hash in kept_hashes:
+                continue
+            self._remove_entry (e.hash)
+            size = size - e.size
+            n_entries = n_entries - 1
+            removed_entries = removed_entries + 1
+            removed_size = removed_size + e.size
+        return Statistics (entries=removed_entries, size=removed_size)
+
+    def enforce_limits (self, keep=()):
+        """Apply the configured cache size limits, see 'evict'.
+        If the limits are exceeded, the cache is reduced a bit below them.
+        """
+        size_limit = config.cache_size_limit
+        entries_limit = config.cache_entries_limit
+        if size_limit is None and entries_limit is None:
+            return Statistics (entries=0, size=0)
+        statistics = self._current_statistics ()
+        if ((size_limit is None or statistics.size <= size_limit) and
+            (entries_limit is None or statistics.entries <= entries_limit)):
+            return Statistics (entries=0, size=0)
+        def lower (limit):
+            if limit is None:
+                return None
+            return int (limit * (1 - self._eviction_margin))
+        return self.evict (size_limit=lower (size_limit), entries_limit=lower (entries_limit),
+                           keep=keep)
+
+    def _remove_stale_temporary_files (self):
+        # Remove temporary files left by crashed processes
+        size = 0
+        limit = time.time () - self._stale_temporary_file_age
+        for directory, _subdirectories, files in os.walk (self._directory):
+            for f in files:
+                if f[:len (self._temporary_file_prefix)] == self._temporary_file_prefix:
+                    file_name = os.path.join (directory, f)
+                    try:
+                        if os.path.getmtime (file_name) < limit:
+                            file_size = os.path.getsize (file_name)
+                            os.remove (file_name)
+                            size = size + file_size
+                    except OSError:
+                        pass
+        return size
+    
+    def compact (self):
+        """Reclaim unused space in the cache.
+        Apply the configured size limits and remove leftovers of interrupted
+        operations.
+        Return pair (BEFORE, AFTER,) of 'Statistics' instances describing the
+        cache before and after the compaction.
+        """
+        before = self.statistics ()
+        self._reset_totals (before)
+        self.evict (size_limit=config.cache_size_limit, entries_limit=config.cache_entries_limit)
+        self._remove_stale_temporary_files ()
+        after = self.statistics ()
+        self._reset_totals (after)
+        return before, after
+
+
+class Flat_Cache (Cache):
+    """Cache storing all files in a single directory.
+    Page copies are named by MD5 hashes of their URLs, each of the metadata
+    items is stored in a separate file named by the copy name with a suffix
+    added.  This is the original WAchecker cache layout.
+    """
+
+    _suffixes = {'charset': '.charset',
+                 'mime_type': '.mimetype',
+                 'headers': '.headers',
+                 'encoding': '.encoding',
+                 'truncated': '.truncated',
+                 }
+    # Items stored only when not empty, so that most entries don't need files
+    # for them; a missing file means an empty value
+    _optional_keys = ('encoding', 'truncated',)
+    # The URL of the entry, not a metadata item
+    _url_suffix = '.url'
+    _content_regexp = re.compile ('^[0-9a-f]{32}$')
+
+    def _all_suffixes (self):
+        return self._suffixes.values () + [self._url_suffix]
+    
+    def _metadata_file_name (self, url, key):
+        return self.content_file_name (url) + self._suffixes[key]
+
+    def content_file_name (self, url):
+        return os.path.join (self._directory, self._hash (url))
+
+    def get (self, url, key):
+        try:
+            f = open (self._metadata_file_name (url, key))
+        except IOError:
+            return None
+        try:
+            return f.read ()
+        finally:
+            f.close ()
+
+    def _write_file (self, file_name, value):
+        try:
+            fd, temporary_name = self._make_temporary_file (self._directory)
+            f = os.fdopen (fd, 'w')
+            try:
+                f.write (value)
+            finally:
+                f.close ()
+            os.rename (temporary_name, file_name)
+        except (IOError, OSError), e:
+            raise exception.System_Error ("Write to local disk failed", e)
+
+    def _remember_url (self, url):
+        file_name = self.content_file_name (url) + self._url_suffix
+        if not os.path.exists (file_name):
+            self._write_file (file_name, str (url))
+        
+    def _commit_content (self, url, temporary_file_name):
+        super (Flat_Cache, self)._commit_content (url, temporary_file_name)
+        self._remember_url (url)
+        
+    def _update (self, url, items, stored_time):
+        self._ensure_directory (self._directory)
+        for key, value in items.items ():
+            file_name = self._metadata_file_name (url, key)
+            if not value and key in self._optional_keys:
+                try:
+                    os.remove (file_name)
+                except OSError:
+                    pass
+                continue
+            self._write_file (file_name, value)
+            if stored_time is not None:
+                try:
+                    os.utime (file_name, (stored_time, stored_time,))
+                except OSError, e:
+                    raise exception.System_Error ("Write to local disk failed", e)
+        self._remember_url (url)
+
+    def modification_time (self, url, key):
+        try:
+            return os.path.getmtime (self._metadata_file_name (url, key))
+        except OSError:
+            return None
+
+    def touch (self, url):
+        try:
+            os.utime (self.content_file_name (url), None)
+        except OSError:
+            pass
+
+    def _delete_entry (self, hash_):
+        file_name = os.path.join (self._directory, hash_)
+        # Remove metadata after the content, so that the content is never
+        # present without its metadata
+        for f in [file_name] + [file_name + s for s in self._all_suffixes ()]:
+            try:
+                os.remove (f)
+            except OSError:
+                pass
+        
+    def _entry_size (self, hash_):
+        file_name = os.path.join (self._directory, hash_)
+        size = None
+        for f in [file_name] + [file_name + s for s in self._all_suffixes ()]:
+            try:
+                size = (size or 0) + os.stat (f).st_size
+            except OSError:
+                pass
+        return size
+
+    def _entries (self):
+        entries = {}
+        try:
+            files = os.listdir (self._directory)
+        except OSError:
+            files = []
+        suffixes = self._all_suffixes ()
+        for f in files:
+            name, suffix = os.path.splitext (f)
+            if self._content_regexp.match (name) and (not suffix or suffix in suffixes):
+                try:
+                    stat = os.stat (os.path.join (self._directory, f))
+                except OSError:
+                    continue
+                entry = entries.get (name)
+                if entry is None:
+                    entry = entries[name] = _Entry (hash=name, last_use=0, size=0)
+                entry.last_use = max (entry.last_use, stat.st_mtime)
+                entry.size = entry.size + stat.st_size
+        return entries.values ()
+
+    def urls (self):
+        try:
+            files = os.listdir (self._directory)
+        except OSError:
+            return []
+        urls = []
+        for f in files:
+            name, suffix = os.path.splitext (f)
+            if suffix == self._url_suffix and self._content_regexp.match (name):
+                try:
+                    url_file = open (os.path.join (self._directory, f))
+                except IOError:
+                    continue
+                try:
+                    urls.append (url_file.read ())
+                finally:
+                    url_file.close ()
+        return urls
+
+
+class Indexed_Cache (Cache):
+    """Cache with an SQLite metadata index and sharded page copies.
+    Metadata of all entries are stored in a single SQLite database, page
+    copies are stored in subdirectories named by the first characters of the
+    MD5 hashes of their URLs.  This keeps the number of files in a single
+    directory low even with millions of cached pages.
+    """
+
+    _index_file_name = 'index.sqlite'
+    _shard_levels = 2
+    _columns = (('hash', 'text primary key',),
+                ('url', 'text',),
+                ('charset', 'text',),
+                ('mime_type', 'text',),
+                ('headers', 'text',),
+                ('metadata_time', 'real',),
+                ('size', 'integer',),
+                ('access_time', 'real',),
+                ('encoding', 'text',),
+                ('truncated', 'text',),
+                )
+
+    def __init__ (self, directory):
+        if sqlite3 is None:
+            raise exception.System_Error ("Indexed cache requires the sqlite3 module", None)
+        super (Indexed_Cache, self).__init__ (directory)
+        self._ensure_directory (directory)
+        self._db_lock = threading.Lock ()
+        index_file_name = os.path.join (directory, self._index_file_name)
+        try:
+            self._db = sqlite3.connect (index_file_name, timeout=60, check_same_thread=False,
+                                        isolation_level=None)
+            self._db.execute ('create table if not exists entries (%s)' %
+                              (', '.join (['%s %s' % c for c in self._columns]),))
+            # Add columns missing in indexes created by older versions
+            existing_columns = [row[1] for row in self._db.execute ('pragma table_info (entries)')]
+            for name, type_ in self._columns:
+                if name not in existing_columns:
+                    self._db.execute ('alter table entries add column %s %s' % (name, type_,))
+        except sqlite3.Error, e:
+            raise exception.System_Error ("Cache index could not be opened", e)
+
+    def _query (self, query, args=()):
+        self._db_lock.acquire ()
+        try:
+            try:
+                return self._db.execute (query, args).fetchall ()
+            except sqlite3.Error, e:
+                raise exception.System_Error ("Cache index access failed", e)
+        finally:
+            self._db_lock.release ()
+
+    def content_file_name (self, url):
+        return self._content_file_name_from_hash (self._hash (url))
+
+    def _commit_content (self, url, temporary_file_name):
+        try:
+            size = os.path.getsize (temporary_file_name)
+        except OSError, e:
+            raise exception.System_Error ("Write to local disk failed", e)
+        super (Indexed_Cache, self)._commit_content (url, temporary_file_name)
+        self._query ('insert or ignore into entries (hash, url) values (?, ?)',
+                     (self._hash (url), unicode (str (url), 'utf-8'),))
+        self._query ('update entries set size = ?, access_time = ? where hash = ?',
+                     (size, time.time (), self._hash (url),))
+
+    def get (self, url, key):
+        assert key in METADATA_KEYS, key
+        rows = self._query ('select %s from entries where hash = ?' % (key,), (self._hash (url),))
+        if not rows or rows[0][0] is None:
+            return None
+        return rows[0][0].encode ('utf-8')
+
+    def lookup (self, urls, key):
+        assert key in METADATA_KEYS, key
+        hashes = {}
+        for url in urls:
+            hashes[self._hash (url)] = url
+        result = {}
+        hash_list = hashes.keys ()
+        # SQLite limits the number of query parameters
+        step = 500
+        for i in range (0, len (hash_list), step):
+            chunk = hash_list[i:i+step]
+            query = ('select hash, %s from entries where hash in (%s)' %
+                     (key, ', '.join (['?'] * len (chunk)),))
+            for hash_, value in self._query (query, chunk):
+                if value is not None:
+                    result[hashes[hash_]] = value.encode ('utf-8')
+        return result
+
+    def _update (self, url, items, stored_time):
+        keys = items.keys ()
+        for k in keys:
+            assert k in METADATA_KEYS, k
+        hash_ = self._hash (url)
+        values = [unicode (str (items[k]), 'utf-8', 'replace') for k in keys]
+        if stored_time is None:
+            stored_time = time.time ()
+        self._db_lock.acquire ()
+        try:
+            try:
+                db = self._db
+                db.execute ('begin immediate')
+                try:
+                    db.execute ('insert or ignore into entries (hash, url) values (?, ?)',
+                                (hash_, unicode (str (url), 'utf-8'),))
+                    assignments = ', '.join (['%s = ?' % (k,) for k in keys] + ['metadata_time = ?'])
+                    db.execute ('update entries set %s where hash = ?' % (assignments,),
+                                values + [stored_time, hash_])
+                except:
+                    db.execute ('rollback')
+                    raise
+                db.execute ('commit')
+            except sqlite3.Error, e:
+                raise exception.System_Error ("Cache index access failed", e)
+        finally:
+            self._db_lock.release ()
+
+    def modification_time (self, url, key):
+        if self.get (url, key) is None:
+            return None
+        rows = self._query ('select metadata_time from entries where hash = ?', (self._hash (url),))
+        return rows and rows[0][0]
+
+    def touch (self, url):
+        self._query ('update entries set access_time = ? where hash = ?', (time.time (), self._hash (url),))
+
+    def urls (self):
+        return [url.encode ('utf-8') for url, in self._query ('select url from entries where url is not null')]
+
+    def _content_file_name_from_hash (self, hash_):
+        shards = [hash_[2*i:2*i+2] for i in range (self._shard_levels)]
+        return os.path.join (self._directory, *(shards + [hash_]))
+    
+    def _delete_entry (self, hash_):
+        try:
+            os.remove (self._content_file_name_from_hash (hash_))
+        except OSError:
+            pass
+        self._query ('delete from entries where hash = ?', (hash_,))
+        
+    def _entries (self):
+        rows = self._query ('select hash, coalesce (access_time, metadata_time, 0), '
+                            'coalesce (size, 0) + coalesce (length (headers), 0) from entries')
+        return [_Entry (hash=h, last_use=t, size=s) for h, t, s in rows]
+
+    def _entry_size (self, hash_):
+        rows = self._query ('select coalesce (size, 0) + coalesce (length (headers), 0) '
+                            'from entries where hash = ?', (hash_,))
+        if not rows:
+            return None
+        return rows[0][0]
+
+    def statistics (self):
+        rows = self._query ('select count (*), total (coalesce (size, 0) + coalesce (length (headers), 0)) '
+                            'from entries')
+        entries, size = rows[0]
+        return Statistics (entries=entries, size=int (size))
+
+    def compact (self):
+        before = self.statistics ()
+        self._reset_totals (before)
+        self.evict (size_limit=config.cache_size_limit, entries_limit=config.cache_entries_limit)
+        self._remove_stale_temporary_files ()
+        # Forget pages whose copies have disappeared
+        for hash_, in self._query ('select hash from entries where size is not null'):
+            if not os.path.exists (self._content_file_name_from_hash (hash_)):
+                self._query ('update entries set size = null where hash = ?', (hash_,))
+        # Remove page copies not present in the index
+        for directory, _subdirectories, files in os.walk (self._directory):
+            for f in files:
+                if (Flat_Cache._content_regexp.match (f) and
+                    not self._query ('select 1 from entries where hash = ? and size is not null', (f,))):
+                    try:
+                        os.remove (os.path.join (directory, f))
+                    except OSError:
+                        pass
+        self._query ('vacuum')
+        after = self.statistics ()
+        self._reset_totals (after)
+        return before, after
+
+
+_backends = {'flat': Flat_Cache,
+             'indexed': Indexed_Cache,
+             }
+_caches = {}
+_caches_lock = threading.Lock ()
+
+def cache ():
+    """Return 'Cache' instance corresponding to the current configuration.
+    The cache backend is selected by 'config.cache_backend', the cache is
+    located in 'config.cache_directory'.
+    """
+    key = (config.cache_backend, config.cache_directory,)
+    _caches_lock.acquire ()
+    try:
+        instance = _caches.get (key)
+        if instance is None:
+            try:
+                backend = _backends[config.cache_backend]
+            except KeyError:
+                raise Exception ("Unknown cache backend", config.cache_backend)
+            instance = _caches[key] = backend (config.cache_directory)
+    finally:
+        _caches_lock.release ()
+    return instance
+
+def compact ():
+    """Compact the configured cache and print a report about it.
+    """
+    before, after = cache ().compact ()
+    print 'Cache directory: %s' % (config.cache_directory,)
+    print 'Entries: %d -> %d' % (before.entries, after.entries,)
+    print 'Size: %d -> %d bytes' % (before.size, after.size,)
+    print 'Reclaimed: %d bytes' % (before.size - after.size,)
+
+
+if __name__ == '__main__':
+    compact ()
@@ -27,16 +27,136 @@ import log
 
 # Directory where cached Web pages are stored
 cache_directory = '/var/lib/wachecker/cache'
+# Layout of the page cache: 'flat' stores all files in a single directory,
+# 'indexed' stores page metadata in an SQLite database and page copies in
+# subdirectories, which is better suited for large caches
+cache_backend = 'flat'
+# Maximum total size of the cache in bytes and maximum number of cache
+# entries; when exceeded, least recently used cache entries are removed.
+# None means no limit.
+cache_size_limit = None
+cache_entries_limit = None
+# If true, store page copies in the cache compressed with gzip; they are
+# decompressed on the fly when read
+cache_compression = False
 # Directories containing tests
 test_directories = ('/usr/lib/python2.3/site-packages/wachecker/tests',)
 
 # Program to use for validating HTML documents
 sgmls_program = 'onsgmls'
 
+# Representation of parsed documents: 'objects' represents each document node
+# by an object, 'arrays' stores node data in arrays, which takes less memory
+# and makes walking over whole documents faster
+document_backend = 'objects'
+
 # If true, read page from the server on every access to it.
 # If false, try to use its cached version by default.
 refresh_cache = False
 
+# Policy of using cached pages, one of the 'location.Cache_Policy' constant
+# names: 'CACHE', 'FRESH', 'REVALIDATE', 'RELOAD'.
+# If None, the policy is determined by 'refresh_cache'.
+cache_policy = None
+
+# Network access mode:
+# 'online' -- pages are retrieved from the network as needed;
+# 'offline' -- only cached pages and headers are used, without any network
+#   access; requests for data missing in the cache fail immediately and the
+#   URLs are recorded, see 'location.offline_misses';
+# 'record' -- all pages and headers, including headers of linked documents,
+#   are retrieved from the network on their first use, ignoring the cache
+#   contents, and stored to the cache.  The cache can be then used to replay
+#   the same checks in the offline mode; it is best to use an empty
+#   'cache_directory' for recording.
+network_mode = 'online'
+
+# WARC files, e.g. results of a crawl by another tool, providing pages to
+# check; responses stored in the files are used instead of retrieving the
+# pages from the network.  The responses are read in place, they are not
+# copied to the cache.  Pages not present in the files are handled according
+# to 'network_mode'.
+warc_files = ()
+# Name of the file where the index of the WARC files is stored, so that it
+# needn't be built again each time the files are used; None means the index is
+# kept in memory only
+warc_index_file = None
+
+# Local directories containing sites to check, e.g. static build output
+# before deployment, as a sequence of pairs (URL_PREFIX, DIRECTORY,).  Pages
+# with URLs starting with URL_PREFIX are read from the corresponding files in
+# DIRECTORY instead of retrieving them, the same way as 'file:' URLs.  Local
+# files are read in place, they are not copied to the cache.  URL paths
+# leading outside DIRECTORY are not mapped.  Note that site-absolute links of
+# 'file:' pages point to the filesystem root, use a site prefix here to check
+# sites containing such links.
+local_sites = ()
+# Name of the file representing a local directory
+local_index_file = 'index.html'
+
+# Maximum number of threads used to resolve links of a page in parallel.
+# If less than 2, links are resolved serially.
+link_resolution_threads = 8
+
+# Engine used to retrieve many URLs at once: 'threads' retrieves them in
+# parallel threads, 'events' retrieves them in a single thread using
+# non-blocking sockets, which allows many more simultaneous requests.  The
+# 'events' engine handles only plain HTTP URLs, others are retrieved the usual
+# way.
+fetch_engine = 'threads'
+# Maximum number of simultaneous connections of the 'events' engine
+fetch_engine_connections = 512
+
+# Maximum number of seconds to wait for a connection to a server and for
+# data from the server; None means no limit
+connect_timeout = 10
+read_timeout = 30
+# If true, ask servers to send pages compressed with gzip or deflate to save
+# transfer time; received pages are decompressed on the fly
+http_compression = True
+# Maximum number of bytes of a page retrieved, longer pages are truncated;
+# None means no limit
+max_page_size = 10 * 1024 * 1024
+# MIME types of pages which may be retrieved from HTTP servers; retrieval of
+# documents of other types is refused before downloading their contents.
+# None means documents of any type may be retrieved.
+retrieved_mime_types = ('text/html', 'application/xhtml+xml', 'text/xml', 'application/xml',
+                        'text/css',)
+# Maximum number of seconds a retrieval of a single URL may take in total,
+# including retries; None means no limit
+fetch_deadline = 120
+# Number of times a failed retrieval is retried; the first retry is delayed
+# by a random time up to 'retry_backoff' seconds, the limit is doubled with
+# each following retry
+fetch_retries = 2
+retry_backoff = 1.0
+
+# Maximum number of simultaneous requests to a single host and minimum number
+# of seconds between starts of two requests to the same host
+host_max_connections = 2
+host_min_interval = 0
+# If true, adapt the number of simultaneous requests to each host to its
+# response times: increase it up to 'host_max_adaptive_connections' while the
+# host responds in less than 'host_latency_threshold' seconds and decrease it
+# when the host responds slower or asks for slowing down
+host_adaptive_concurrency = False
+host_max_adaptive_connections = 8
+host_latency_threshold = 1.0
+
+# Number of seconds a failed attempt to retrieve URL headers is remembered
+# before the URL is tried again
+negative_cache_ttl = 300
+
+# Number of consecutive connection failures after which requests to the host
+# are refused immediately, and the number of seconds after which the host is
+# tried again
+circuit_breaker_threshold = 5
+circuit_breaker_cooldown = 60
+
+# Maximum number of URLs whose headers, MIME types and other information is
+# remembered in memory, to avoid their repeated retrieval
+url_registry_size = 10000
+
 # Logging instance
 logger = log.Logger (sys.stderr)
 
@@ -0,0 +1,598 @@
+### connection.py --- Persistent HTTP connections
+
+## Copyright (C) 2006 Brailcom, o.p.s.
+##
+## Author: Milan Zamazal <pdm@brailcom.org>
+##
+## COPYRIGHT NOTICE
+##
+## This program is free software; you can redistribute it and/or modify it
+## under the terms of the GNU General Public License as published by the Free
+## Software Foundation; either version 2 of the License, or (at your option)
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+## more details.
+##
+## You should have received a copy of the GNU General Public License along with
+## this program; if not, write to the Free Software Foundation, Inc., 51
+## Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import base64
+import httplib
+import random
+import socket
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+from charseq import str
+import exception
+
+
+def split_netloc (netloc):
+    """Return pair (HOST, AUTHORIZATION,) of URL network location 'netloc'.
+    HOST is 'netloc' without user information, AUTHORIZATION is the value of
+    the Authorization request header corresponding to the user information or
+    None if there is no user information.
+    """
+    if '@' not in netloc:
+        return netloc, None
+    userinfo, host = netloc.rsplit ('@', 1)
+    return host, 'Basic ' + base64.b64encode (urllib.unquote (userinfo))
+
+def proxy_used (url):
+    """Return true iff 'url' is to be retrieved through a proxy.
+    Proxies are configured in the environment the same way as for 'urllib'.
+    """
+    parsed_url = urlparse.urlparse (url)
+    if not urllib.getproxies ().has_key (parsed_url[0].lower ()):
+        return False
+    return not urllib.proxy_bypass (split_netloc (parsed_url[1])[0])
+
+
+class Unsupported_Redirection_Error (exception.System_Error):
+    """Exception signalling redirection to a URL the client can't retrieve.
+    Such a request can be performed by 'urllib2' instead.
+    """
+
+    def __init__ (self, url):
+        exception.System_Error.__init__ (self, "Redirection to unsupported URL", None, url)
+        
+    def url (self):
+        """Return the URL the request was redirected to.
+        """
+        return self.args[2]
+
+
+class Response (object):
+    """HTTP response returned by 'Connection_Pool.request'.
+    The response body must be read completely or the response must be closed
+    before the underlying connection can be used again.
+    """
+
+    def __init__ (self, url, response, release, prepare_read=None):
+        """'url' is the URL of the response, 'response' is the
+        'httplib.HTTPResponse' instance and 'release' is a function of no
+        arguments called when the response is closed.
+        'prepare_read', if not None, is a function of no arguments called before
+        each body read; it may raise 'exception.System_Error' to abort reading.
+        """
+        self._url = url
+        self._response = response
+        self._release = release
+        self._prepare_read = prepare_read
+
+    def url (self):
+        """Return the URL of the response, after following redirections.
+        """
+        return self._url
+
+    def status (self):
+        """Return HTTP status code of the response, as an integer.
+        """
+        return self._response.status
+
+    def headers (self):
+        """Return response headers as an 'httplib.HTTPMessage' instance.
+        """
+        return self._response.msg
+
+    def read (self, size=None):
+        """Read and return at most 'size' bytes of the response body.
+        If 'size' is None, read the whole remaining body.
+        """
+        try:
+            if self._prepare_read is not None:
+                self._prepare_read ()
+            if size is None:
+                data = self._response.read ()
+            else:
+                data = self._response.read (size)
+        except (socket.error, httplib.HTTPException, exception.System_Error), e:
+            self.close ()
+            if isinstance (e, exception.System_Error):
+                raise
+            raise exception.System_Error ("URL could not be retrieved", e)
+        if not data:
+            self.close ()
+        return data
+
+    def close (self):
+        """Finish using the response and release its connection.
+        """
+        release = self._release
+        if release is not None:
+            self._release = None
+            release ()
+    
+
+ACCEPTED_ENCODINGS = 'gzip, deflate'
+"""Value of the Accept-Encoding request header for encodings 'Content_Decoder'
+can decode.
+"""
+
+class Content_Decoder (object):
+    """Streaming decoder of HTTP response bodies.
+    The body data is decoded according to the content coding given in the
+    Content-Encoding response header.
+    """
+
+    def __init__ (self, encoding):
+        """'encoding' is the value of the Content-Encoding header or None.
+        'exception.System_Error' is raised if the encoding is not supported.
+        """
+        encoding = (encoding or '').strip ().lower ()
+        if encoding in ('', 'identity',):
+            self._decompressor = None
+        elif encoding in ('gzip', 'x-gzip',):
+            self._decompressor = zlib.decompressobj (16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._decompressor = zlib.decompressobj ()
+        else:
+            raise exception.System_Error ("Unsupported content encoding", None, encoding)
+        self._encoding = encoding
+        self._started = False
+
+    def decode (self, data):
+        """Return decoded piece of the body following the previous ones.
+        """
+        decompressor = self._decompressor
+        if decompressor is None or not data:
+            return data
+        try:
+            try:
+                decoded = decompressor.decompress (data)
+            except zlib.error:
+                if self._started or self._encoding != 'deflate':
+                    raise
+                # Some servers send raw deflate data without the zlib wrapper
+                decompressor = self._decompressor = zlib.decompressobj (-zlib.MAX_WBITS)
+                decoded = decompressor.decompress (data)
+        except zlib.error, e:
+            raise exception.System_Error ("Invalid compressed data", e)
+        self._started = True
+        return decoded
+
+    def flush (self):
+        """Return the rest of the decoded body after all the data were passed.
+        """
+        if self._decompressor is None:
+            return ''
+        try:
+            return self._decompressor.flush ()
+        except zlib.error, e:
+            raise exception.System_Error ("Invalid compressed data", e)
+    
+
+class Host_Not_Available_Error (exception.System_Error):
+    """Exception raised when a request is refused by a 'Circuit_Breaker'.
+    """
+
+    def __init__ (self, host):
+        exception.System_Error.__init__ (self, "Host not available", None, host)
+
+    
+class Circuit_Breaker (object):
+    """Tracker of unavailable hosts.
+    After 'threshold' consecutive failures of connections to a host, the host
+    is considered unavailable and requests to it are refused for 'cooldown'
+    seconds.  Then a single request is allowed again; if it fails, the host is
+    refused for another 'cooldown' period, otherwise it is considered available
+    again.
+    """
+
+    def __init__ (self, threshold, cooldown):
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._failures = {}
+        self._refused_since = {}
+        self._lock = threading.Lock ()
+
+    def allow (self, host):
+        """Return true iff a request to 'host' may be performed now.
+        """
+        self._lock.acquire ()
+        try:
+            if self._failures.get (host, 0) < self._threshold:
+                return True
+            now = time.time ()
+            if now - self._refused_since[host] < self._cooldown:
+                return False
+            # Let this request try whether the host is alive again, but refuse
+            # the others until it's known
+            self._refused_since[host] = now
+            return True
+        finally:
+            self._lock.release ()
+
+    def succeeded (self, host):
+        """Record successful connection to 'host'.
+        """
+        self._lock.acquire ()
+        try:
+            if self._failures.has_key (host):
+                del self._failures[host]
+        finally:
+            self._lock.release ()
+
+    def failed (self, host):
+        """Record failed connection to 'host'.
+        """
+        self._lock.acquire ()
+        try:
+            failures = self._failures[host] = self._failures.get (host, 0) + 1
+            if failures >= self._threshold:
+                self._refused_since[host] = time.time ()
+        finally:
+            self._lock.release ()
+
+            
+class _Host_State (object):
+
+    def __init__ (self, limit):
+        self.active = 0
+        self.limit = limit
+        self.next_time = 0
+        self.successes = 0
+
+        
+class Host_Scheduler (object):
+    """Scheduler of requests to hosts.
+    The scheduler limits the number of simultaneous requests to a single host
+    and enforces minimum delay between starts of requests to the same host.
+    In the adaptive mode, the number of simultaneous requests to a host is
+    increased while the host responds fast, and decreased when the host
+    responds slowly or asks for slowing down with the HTTP status 429 or 503.
+    The scheduler may be used from several threads simultaneously.
+    """
+
+    _slow_down_codes = (429, 503,)
+    _max_retry_after = 60
+    
+    def __init__ (self, max_connections=2, min_interval=0, adaptive=False,
+                  max_adaptive_connections=8, latency_threshold=1.0):
+        """'max_connections' is the maximum number of simultaneous requests to
+        a single host, in the adaptive mode it is the initial number.
+        'min_interval' is the minimum number of seconds between starts of two
+        requests to the same host.
+        If 'adaptive' is true, the number of simultaneous requests is adapted
+        to the host responses, but it never exceeds 'max_adaptive_connections'.
+        Responses received in less than 'latency_threshold' seconds are
+        considered fast.
+        """
+        self._max_connections = max_connections
+        self._min_interval = min_interval
+        self._adaptive = adaptive
+        self._max_adaptive_connections = max_adaptive_connections
+        self._latency_threshold = latency_threshold
+        self._hosts = {}
+        self._condition = threading.Condition ()
+
+    def _host_state (self, host):
+        state = self._hosts.get (host)
+        if state is None:
+            state = self._hosts[host] = _Host_State (self._max_connections)
+        return state
+
+    def _start (self, state, now):
+        state.active = state.active + 1
+        state.next_time = max (state.next_time, now + self._min_interval)
+        
+    def acquire (self, host, deadline=None):
+        """Wait until a request to 'host' may be started.
+        'deadline' is the time by which the request must be started, if it
+        can't, 'exception.System_Error' is raised.
+        Each successful 'acquire' call must be followed by a 'release' call.
+        """
+        condition = self._condition
+        condition.acquire ()
+        try:
+            state = self._host_state (host)
+            while True:
+                now = time.time ()
+                if state.active < state.limit and now >= state.next_time:
+                    break
+                if deadline is not None and now >= deadline:
+                    raise exception.System_Error ("Retrieval time limit exceeded", None)
+                if state.active < state.limit:
+                    timeout = state.next_time - now
+                else:
+                    # Wait for a 'release' call, but check the deadline from
+                    # time to time
+                    timeout = 1
+                if deadline is not None:
+                    timeout = min (timeout, deadline - now)
+                condition.wait (timeout)
+            self._start (state, now)
+        finally:
+            condition.release ()
+
+    def try_acquire (self, host):
+        """Start a request to 'host' if it may be started now.
+        Return true iff the request may be started, in such a case a 'release'
+        call must follow.  Unlike 'acquire', this method never waits, it is
+        intended for event driven callers.
+        """
+        condition = self._condition
+        condition.acquire ()
+        try:
+            state = self._host_state (host)
+            now = time.time ()
+            if state.active >= state.limit or now < state.next_time:
+                return False
+            self._start (state, now)
+            return True
+        finally:
+            condition.release ()
+
+    def release (self, host, latency=None, status=None, retry_after=None):
+        """Finish a request to 'host' started after an 'acquire' call.
+        'latency' is the number of seconds it took to receive the response
+        headers, 'status' is the HTTP status code of the response and
+        'retry_after' is the value of the Retry-After response header.  All the
+        values are None if the request failed.
+        """
+        condition = self._condition
+        condition.acquire ()
+        try:
+            state = self._hosts[host]
+            state.active = state.active - 1
+            if status in self._slow_down_codes:
+                try:
+                    delay = min (int (retry_after), self._max_retry_after)
+                except (TypeError, ValueError):
+                    delay = max (self._min_interval * 2, 1)
+                state.next_time = max (state.next_time, time.time () + delay)
+                if self._adaptive:
+                    state.limit = max (state.limit / 2, 1)
+                    state.successes = 0
+            elif self._adaptive and latency is not None:
+                if latency < self._latency_threshold:
+                    state.successes = state.successes + 1
+                    if (state.successes >= state.limit and
+                        state.limit < self._max_adaptive_connections):
+                        state.limit = state.limit + 1
+                        state.successes = 0
+                else:
+                    state.limit = max (state.limit - 1, 1)
+                    state.successes = 0
+            condition.notifyAll ()
+        finally:
+            condition.release ()
+    
+        
+class Connection_Pool (object):
+    """Pool of persistent HTTP connections.
+    Connections are kept open after a request and reused by subsequent
+    requests to the same host, so that checking many URLs located on the same
+    server doesn't require opening new TCP connection for each of them.
+    Proxies are not supported, URLs to be retrieved through a proxy are not
+    supported by the pool, see 'supports'.
+    The pool may be used from several threads simultaneously.
+    """
+
+    _connection_classes = {'http': httplib.HTTPConnection,
+                           'https': httplib.HTTPSConnection,
+                           }
+    _redirection_codes = (301, 302, 303, 307, 308,)
+    _retry_codes = (429, 500, 502, 503, 504,)
+    _user_agent = 'WAchecker'
+    
+    def __init__ (self, max_idle_connections=4, max_redirections=5, circuit_breaker=None,
+                  connect_timeout=None, read_timeout=None, retries=0, retry_backoff=1.0,
+                  scheduler=None):
+        """'max_idle_connections' is the maximum number of unused connections
+        kept open for each of the hosts.
+        'max_redirections' is the maximum number of HTTP redirections followed
+        in a single request.
+        'circuit_breaker' is a 'Circuit_Breaker' instance used to refuse
+        requests to unavailable hosts, or None.
+        'connect_timeout' and 'read_timeout' are the maximum numbers of seconds
+        to wait for a connection to be established and for data to arrive,
+        respectively.  None means waiting without limit.
+        'retries' is the number of times a request is repeated after a
+        connection failure or a temporary server error.  The first repetition
+        is delayed by a random time up to 'retry_backoff' seconds, the limit is
+        doubled with each following repetition.
+        'scheduler' is a 'Host_Scheduler' instance controlling the rate of
+        requests to hosts, or None.
+        """
+        self._max_idle_connections = max_idle_connections
+        self._max_redirections = max_redirections
+        self._circuit_breaker = circuit_breaker
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._retries = retries
+        self._retry_backoff = retry_backoff
+        self._scheduler = scheduler
+        self._idle_connections = {}
+        self._lock = threading.Lock ()
+
+    def _key (self, url):
+        parsed_url = urlparse.urlparse (url)
+        return (parsed_url[0].lower (), split_netloc (parsed_url[1])[0].lower (),)
+
+    def _make_connection (self, key):
+        protocol, host = key
+        return self._connection_classes[protocol] (host)
+
+    def _timeout (self, timeout, deadline):
+        if deadline is not None:
+            remaining = deadline - time.time ()
+            if remaining <= 0:
+                raise exception.System_Error ("Retrieval time limit exceeded", None)
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return timeout
+    
+    def _get_connection (self, key):
+        self._lock.acquire ()
+        try:
+            connections = self._idle_connections.get (key)
+            if connections:
+                return connections.pop (), True
+        finally:
+            self._lock.release ()
+        return self._make_connection (key), False
+
+    def _put_connection (self, key, connection):
+        self._lock.acquire ()
+        try:
+            connections = self._idle_connections.setdefault (key, [])
+            if len (connections) < self._max_idle_connections:
+                connections.append (connection)
+                connection = None
+        finally:
+            self._lock.release ()
+        if connection is not None:
+            connection.close ()
+
+    def _request_once (self, method, url, headers, deadline):
+        key = self._key (url)
+        parsed_url = urlparse.urlparse (url)
+        path = urlparse.urlunparse (('', '',) + tuple (parsed_url[2:5]) + ('',)) or '/'
+        request_headers = {'User-Agent': self._user_agent}
+        authorization = split_netloc (parsed_url[1])[1]
+        if authorization is not None:
+            request_headers['Authorization'] = authorization
+        request_headers.update (headers)
+        circuit_breaker = self._circuit_breaker
+        host = key[1]
+        if circuit_breaker is not None and not circuit_breaker.allow (host):
+            raise Host_Not_Available_Error (host)
+        scheduler = self._scheduler
+        if scheduler is not None:
+            scheduler.acquire (host, deadline)
+        try:
+            start_time = time.time ()
+            connect_timeout = self._timeout (self._connect_timeout, deadline)
+            read_timeout = self._timeout (self._read_timeout, deadline)
+            while True:
+                connection, reused = self._get_connection (key)
+                try:
+                    if connection.sock is None:
+                        connection.timeout = connect_timeout
+                        connection.connect ()
+                    connection.sock.settimeout (read_timeout)
+                    connection.request (method, path, headers=request_headers)
+                    response = connection.getresponse ()
+                except (socket.error, httplib.HTTPException), e:
+                    connection.close ()
+                    if reused:
+                        # The server has probably closed the idle connection
+                        # in the meantime, try again with another one
+                        continue
+                    if circuit_breaker is not None:
+                        circuit_breaker.failed (host)
+                    raise exception.System_Error ("URL could not be retrieved", e)
+                break
+        except:
+            if scheduler is not None:
+                scheduler.release (host)
+            raise
+        latency = time.time () - start_time
+        if circuit_breaker is not None:
+            circuit_breaker.succeeded (host)
+        def release ():
+            if response.isclosed () and not response.will_close:
+                self._put_connection (key, connection)
+            else:
+                connection.close ()
+            if scheduler is not None:
+                scheduler.release (host, latency=latency, status=response.status,
+                                   retry_after=response.getheader ('retry-after'))
+        if method == 'HEAD':
+            response.read ()
+        def prepare_read ():
+            if connection.sock is not None:
+                connection.sock.settimeout (self._timeout (self._read_timeout, deadline))
+        return Response (url, response, release, prepare_read)
+
+    def supports (self, url):
+        """Return true iff 'url' can be retrieved using the pool.
+        """
+        return self._connection_classes.has_key (self._key (url)[0]) and not proxy_used (url)
+    
+    def request (self, method, url, headers={}, deadline=None):
+        """Perform HTTP request and return its 'Response'.
+        'method' is the HTTP method name, 'url' is the requested URL and
+        'headers' is a dictionary of additional request headers.
+        'deadline', if not None, is the time (as returned by 'time.time') by
+        which the request including reading the response must be completed.
+        HTTP redirections are followed, failed requests are retried as
+        configured in the constructor.  Redirections to URLs not supported by
+        the pool raise 'Unsupported_Redirection_Error'.
+        'exception.System_Error' is raised if the request can't be performed.
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self._request_redirected (method, url, headers, deadline)
+                if response.status () not in self._retry_codes or attempt >= self._retries:
+                    return response
+                # Don't wait for the error page
+                response.close ()
+            except (Host_Not_Available_Error, Unsupported_Redirection_Error,):
+                raise
+            except exception.System_Error:
+                if attempt >= self._retries:
+                    raise
+            delay = random.uniform (0, self._retry_backoff * 2 ** attempt)
+            if deadline is not None and time.time () + delay >= deadline:
+                raise exception.System_Error ("Retrieval time limit exceeded", None)
+            time.sleep (delay)
+            attempt = attempt + 1
+        
+    def _request_redirected (self, method, url, headers, deadline):
+        url = str (url)
+        for _i in range (self._max_redirections + 1):
+            response = self._request_once (method, url, headers, deadline)
+            location = response.headers ().getheader ('location')
+            if response.status () not in self._redirection_codes or not location:
+                return response
+            response.read ()
+            response.close ()
+            url = str (urlparse.urljoin (url, location))
+            if not self.supports (url):
+                raise Unsupported_Redirection_Error (url)
+            if response.status () == 303 and method != 'HEAD':
+                method = 'GET'
+        raise exception.System_Error ("Too many HTTP redirections", None)
+
+    def close (self):
+        """Close all idle connections.
+        """
+        self._lock.acquire ()
+        try:
+            all_connections = self._idle_connections.values ()
+            self._idle_connections = {}
+        finally:
+            self._lock.release ()
+        for connections in all_connections:
+            for c in connections:
+                c.close ()
@@ -20,13 +20,14 @@
 ## this program; if not, write to the Free Software Foundation, Inc., 51
 ## Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import array
 import htmlentitydefs
 import HTMLParser
 import string
 import StringIO
 
 from charseq import str
-from charseq import String as S
+import config
 import css
 import util
 
@@ -34,6 +35,15 @@ import util
 class Node (object):
     """'Document' nodes.
     """
+    # Documents may contain millions of nodes, so they are kept small: there
+    # is no instance dictionary and nodes without attributes, children or
+    # style don't allocate their own containers.  Texts are stored in separate
+    # 'Text_Node' instances.  Each node knows its position among its parent's
+    # children, so that its siblings can be found without searching.
+    # All nodes of a tree share a dictionary of the 'all_text' results, which
+    # is cleared whenever the tree is modified.
+    __slots__ = ('_parent', '_name', '_attrs', '_children', '_style', '_input_position',
+                 '_sibling_index', '_all_texts',)
 
     def __init__ (self, parent, name, attrs, input_position):
         """Construct node named 'name' with 'parent' node.
@@ -45,11 +55,29 @@ class Node (object):
         """
         self._parent = parent
         self._name = str (name)
-        self._attrs = [(str (x[0]), x[1],) for x in attrs]
-        self._children = []
-        self._text = ''
-        self._style = {}
+        self._attrs = tuple ([(str (x[0]), x[1],) for x in attrs])
+        self._children = ()
+        self._style = None
         self._input_position = input_position
+        self._sibling_index = None
+        if parent is None:
+            self._all_texts = {}
+        else:
+            self._all_texts = parent._all_texts
+
+    def __getstate__ (self):
+        # Classes with __slots__ can't be pickled with the older pickle
+        # protocols without this
+        state = {}
+        for class_ in self.__class__.__mro__:
+            for name in getattr (class_, '__slots__', ()):
+                if hasattr (self, name):
+                    state[name] = getattr (self, name)
+        return state
+
+    def __setstate__ (self, state):
+        for name, value in state.items ():
+            setattr (self, name, value)
 
     def name (self):
         """Return node's name.
@@ -59,41 +87,35 @@ class Node (object):
     def text (self):
         """Return node's text, as a string.
         """
-        if self.name ():
-            text = ''
-            for c in self.children ():
-                if not c.name ():
-                    text = text + c.text ()
-            return text
-        else:
-            return self._text
+        return ''.join ([c.text () for c in self.children () if not c.name ()])
 
     def text_ (self):
         """If this is a text node, return its text, else return None.
         """
-        if self.name ():
-            text = None
-        else:
-            text = self._text
-        return text
+        return None
 
     def all_text (self):
         """Return node's text, included texts of its children, as a string.
         """
-        text = ''
-        for node in self.iter_subtree ():
-            text = text + (node.text_ () or '')
+        all_texts = self._all_texts
+        text = all_texts.get (self)
+        if text is None:
+            text = all_texts[self] = ''.join ([node.text_ () or '' for node in self.iter_subtree ()])
         return text
 
+    def _modified (self):
+        if self._all_texts:
+            self._all_texts.clear ()
+        
     def add_text (self, text):
         """Append 'text' to the node.
+        If the last node's child is a text node, 'text' is appended to it.
         """
-        if self.name ():
-            text_node = Node (self, '', (), self.input_position ())
-            text_node.add_text (text)
-            self.append_child (text_node)
+        children = self._children
+        if children and isinstance (children[-1], Text_Node):
+            children[-1].add_text (text)
         else:
-            self._text = self._text + str (text)
+            self.append_child (Text_Node (self, text, self.input_position ()))
         
     def attr (self, name):
         """Return the value of the attribute named 'name'.
@@ -114,6 +136,8 @@ class Node (object):
         Return value is a dictionary with property names as keys and their
         values as values.
         """
+        if self._style is None:
+            return {}
         return self._style
 
     def set_style (self, style):
@@ -136,20 +160,35 @@ class Node (object):
     def append_child (self, child):
         """Add new 'child' node and return it.
         """
-        self._children.append (child)
+        self._modified ()
+        if self._children:
+            self._children.append (child)
+        else:
+            self._children = [child]
+        child._sibling_index = len (self._children) - 1
         return child
 
-    def next_child (self, child):
-        """Return the next node's child after 'child'.
-        """
+    def _child_index (self, child):
+        # Return index of 'child' in the children list or the list length if
+        # it is not there
         children = self.children ()
+        i = child._sibling_index
+        if i is not None and i < len (children) and children[i] is child:
+            return i
         i = 0
         clen = len (children)
         while i < clen:
             if children[i] is child:
                 break
             i = i + 1
-        i = i + 1
+        return i
+        
+    def next_child (self, child):
+        """Return the next node's child after 'child'.
+        """
+        children = self.children ()
+        clen = len (children)
+        i = self._child_index (child) + 1
         next_child = None
         if i < clen:
             next_child = children[i]
@@ -159,13 +198,7 @@ class Node (object):
         """Return the previous node's child before 'child'.
         """
         children = self.children ()
-        i = 0
-        clen = len (children)
-        while i < clen:
-            if children[i] is child:
-                break
-            i = i + 1
-        i = i - 1
+        i = self._child_index (child) - 1
         prev_child = None
         if i >= 0:
             prev_child = children[i]
@@ -190,12 +223,12 @@ class Node (object):
     def next_node (self):
         """Return the next node after this node, on any level.
         If there is no such node, return None."""
-        node = self.next_sibling ()
-        if node:
-            return node
-        parent = self.parent ()
-        if parent:
-            return parent.next_node ()
+        node = self
+        while node:
+            sibling = node.next_sibling ()
+            if sibling:
+                return sibling
+            node = node.parent ()
         return None
 
     def input_position (self):
@@ -205,13 +238,69 @@ class Node (object):
         """
         return self._input_position
     
+    # The iterators use explicit stacks of child iterators instead of
+    # recursion, so that their cost doesn't depend on the tree depth and deep
+    # documents don't exceed the recursion limit.
+    
     def iter_subtree (self):
         """Iterator over all node subnodes.
+        The subnodes are visited in the pre-order, i.e. each node before its
+        children.
         """
-        for child in self.children ():
-            yield child
-            for node in child.iter_subtree ():
+        stack = [iter (self._children)]
+        while stack:
+            for node in stack[-1]:
                 yield node
+                if node._children:
+                    stack.append (iter (node._children))
+                    break
+            else:
+                stack.pop ()
+
+    def iter_subtree_postorder (self):
+        """Iterator over all node subnodes in the post-order.
+        Each node is visited after all its children.
+        """
+        stack = [iter (self._children)]
+        parents = []
+        while stack:
+            for node in stack[-1]:
+                if node._children:
+                    stack.append (iter (node._children))
+                    parents.append (node)
+                    break
+                yield node
+            else:
+                stack.pop ()
+                if parents:
+                    yield parents.pop ()
+
+    def iter_subtree_depths (self, postorder=False):
+        """Iterator over pairs (NODE, DEPTH,) of all node subnodes.
+        DEPTH is the distance of NODE from this node, it is 1 for the node's
+        children.
+        If 'postorder' is true, visit the nodes in the post-order, otherwise in
+        the pre-order.
+        """
+        stack = [iter (self._children)]
+        parents = []
+        while stack:
+            for node in stack[-1]:
+                depth = len (stack)
+                if not postorder:
+                    yield node, depth
+                if node._children:
+                    stack.append (iter (node._children))
+                    parents.append (node)
+                    break
+                if postorder:
+                    yield node, depth
+            else:
+                stack.pop ()
+                if parents:
+                    node = parents.pop ()
+                    if postorder:
+                        yield node, len (stack)
 
     def iter_subtree_tags (self, tags):
         """Iterator over all node subnodes specified by 'tags'.
@@ -222,6 +311,49 @@ class Node (object):
                 yield node
 
 
+class Text_Node (Node):
+    """'Document' nodes containing text.
+    Text nodes have empty names and no attributes, children and style.
+    """
+    # Text added in pieces is collected in a list and joined on the first
+    # access to it
+    __slots__ = ('_text',)
+
+    def __init__ (self, parent, text, input_position):
+        """Construct node containing 'text' with 'parent' node.
+        'input_position' is the same as in 'Node.__init__'.
+        """
+        self._parent = parent
+        self._name = ''
+        self._attrs = ()
+        self._children = ()
+        self._style = None
+        self._input_position = input_position
+        self._sibling_index = None
+        if parent is None:
+            self._all_texts = {}
+        else:
+            self._all_texts = parent._all_texts
+        self._text = str (text)
+
+    def text (self):
+        text = self._text
+        if isinstance (text, list):
+            text = self._text = ''.join (text)
+        return text
+
+    def text_ (self):
+        return self.text ()
+
+    def add_text (self, text):
+        self._modified ()
+        text = str (text)
+        if isinstance (self._text, list):
+            self._text.append (text)
+        else:
+            self._text = [self._text, text]
+
+
 class Document_Error (util.Structure):
     """Error in document structure.
     """
@@ -259,7 +391,7 @@ class Document (object):
         self._doctype = None
         self._location = location
         self._current_node = self._document
-        self._stylesheets_assigned = False
+        self._stylesheet_errors = None
 
     def location (self):
         """Return document location as 'location.Location' or None.
@@ -288,7 +420,7 @@ class Document (object):
     def add_text (self, text):
         """Add text to the current node.
         """
-        self._current_node.add_text (S (text))
+        self._current_node.add_text (text)
 
     def doctype (self):
         """Return document type as a string if set, or None.
@@ -333,9 +465,12 @@ class Document (object):
     # Stylesheets
 
     def assign_stylesheets (self):
-        if self._stylesheets_assigned:
-            errors = None
-        else:
+        """Assign styles to all document nodes, if not assigned yet.
+        Return the list of stylesheet errors; the same list is returned on
+        all calls, so that all tests sharing the document may report them.
+        """
+        errors = self._stylesheet_errors
+        if errors is None:
             errors = []
             stylesheet = util.Variable (css.Stylesheet (()))
             default_stylesheet_type = util.Variable (None)
@@ -416,10 +551,353 @@ class Document (object):
                                                                       data=style))
                 node.set_style (properties)
             self.for_all_nodes (assign_properties)
-            self._stylesheets_assigned = True
+            self._stylesheet_errors = errors
         return errors
     
 
+_TEXT_TAG = 0
+"""Tag id of text nodes in 'Array_Document'.
+"""
+
+class Array_Node (Node):
+    """View of an 'Array_Document' node.
+    Views don't contain any node data, they are created on demand when a node
+    is requested.  So there may be several views of the same node, which are
+    equal, but not identical.
+    Nodes of array documents can't be modified, except for their style.
+    """
+    __slots__ = ('_store', '_index',)
+
+    def __init__ (self, store, index):
+        """Make view of the node numbered 'index' in 'Array_Document' 'store'.
+        """
+        self._store = store
+        self._index = index
+
+    def __eq__ (self, other):
+        return (isinstance (other, Array_Node) and
+                self._index == other._index and self._store is other._store)
+
+    def __ne__ (self, other):
+        return not self.__eq__ (other)
+
+    def __hash__ (self):
+        return hash ((id (self._store), self._index,))
+
+    def _node (self, index):
+        if index < 0:
+            return None
+        return Array_Node (self._store, index)
+        
+    def name (self):
+        store = self._store
+        return store._tag_names[store._tags[self._index]]
+
+    def text (self):
+        store = self._store
+        i = self._index
+        if store._tags[i] == _TEXT_TAG:
+            return store._text (i)
+        texts = []
+        tags = store._tags
+        next_siblings = store._next_siblings
+        child = store._first_children[i]
+        while child >= 0:
+            if tags[child] == _TEXT_TAG:
+                texts.append (store._text (child))
+            child = next_siblings[child]
+        return ''.join (texts)
+
+    def text_ (self):
+        store = self._store
+        i = self._index
+        if store._tags[i] != _TEXT_TAG:
+            return None
+        return store._text (i)
+
+    def all_text (self):
+        store = self._store
+        text = store._all_texts.get (self._index)
+        if text is None:
+            tags = store._tags
+            texts = [store._text (j) for j in xrange (self._index + 1, store._subtree_end (self._index))
+                     if tags[j] == _TEXT_TAG]
+            text = store._all_texts[self._index] = ''.join (texts)
+        return text
+
+    def add_text (self, text):
+        raise Exception ("Array document nodes can't be modified")
+
+    def attr (self, name):
+        for a in self._store._attrs[self._index]:
+            if a[0] == name:
+                return a[1]
+        return None
+
+    def attribute_names (self):
+        return [a[0] for a in self._store._attrs[self._index]]
+
+    def style (self):
+        return self._store._styles.get (self._index, {})
+
+    def set_style (self, style):
+        assert isinstance (style, dict), "Invalid argument type"
+        self._store._styles[self._index] = style
+
+    def parent (self):
+        return self._node (self._store._parents[self._index])
+
+    def children (self):
+        store = self._store
+        next_siblings = store._next_siblings
+        children = []
+        child = store._first_children[self._index]
+        while child >= 0:
+            children.append (Array_Node (store, child))
+            child = next_siblings[child]
+        return children
+
+    def append_child (self, child):
+        raise Exception ("Array document nodes can't be modified")
+
+    def next_child (self, child):
+        return child.next_sibling ()
+
+    def prev_child (self, child):
+        return child.prev_sibling ()
+
+    def next_sibling (self):
+        return self._node (self._store._next_siblings[self._index])
+
+    def prev_sibling (self):
+        return self._node (self._store._prev_siblings[self._index])
+
+    def next_node (self):
+        # In the pre-order, the node following the subtree is the next sibling
+        # of the nearest of this node and its ancestors having one
+        store = self._store
+        end = store._subtree_end (self._index)
+        if end >= len (store._tags):
+            return None
+        return Array_Node (store, end)
+
+    def input_position (self):
+        store = self._store
+        line = store._lines[self._index]
+        if line < 0:
+            return None
+        return (line, store._columns[self._index],)
+
+    def iter_subtree (self):
+        store = self._store
+        for i in xrange (self._index + 1, store._subtree_end (self._index)):
+            yield Array_Node (store, i)
+
+    def iter_subtree_postorder (self):
+        for node, _depth in self.iter_subtree_depths (postorder=True):
+            yield node
+
+    def iter_subtree_depths (self, postorder=False):
+        # Nodes whose subtrees are being visited are kept in 'open_nodes'
+        store = self._store
+        parents = store._parents
+        start = self._index
+        open_nodes = [start]
+        for i in xrange (start + 1, store._subtree_end (start)):
+            while parents[i] != open_nodes[-1]:
+                j = open_nodes.pop ()
+                if postorder:
+                    yield Array_Node (store, j), len (open_nodes)
+            if not postorder:
+                yield Array_Node (store, i), len (open_nodes)
+            open_nodes.append (i)
+        while len (open_nodes) > 1:
+            j = open_nodes.pop ()
+            if postorder:
+                yield Array_Node (store, j), len (open_nodes)
+
+    def iter_subtree_tags (self, tags):
+        return self._store._iter_tags (tags, self._index)
+
+
+class Array_Document (Document):
+    """Representation of an HTML document stored in arrays.
+    Instead of node objects, the document stores node data in parallel arrays
+    indexed by node numbers, the nodes are numbered in the pre-order.  Nodes
+    are represented by 'Array_Node' views created on demand.  This makes
+    documents much smaller and walking over all document nodes faster than
+    with 'Document', and the documents can be pickled cheaply.
+    All the texts are stored in a single string, text nodes contain offsets
+    to it.
+    """
+
+    _ARRAYS = ('_tags', '_parents', '_first_children', '_last_children', '_next_siblings',
+               '_prev_siblings', '_subtree_ends', '_text_starts', '_text_ends', '_lines', '_columns',)
+
+    def __init__ (self, location=None):
+        """'location', if given, is the originating location of the document.
+        """
+        self._doctype = None
+        self._location = location
+        self._stylesheet_errors = None
+        self._tag_names = ['']
+        self._tag_ids = {'': _TEXT_TAG}
+        self._tags = array.array ('i')
+        self._parents = array.array ('i')
+        self._first_children = array.array ('i')
+        self._last_children = array.array ('i')
+        self._next_siblings = array.array ('i')
+        self._prev_siblings = array.array ('i')
+        # Number of the first node after the subtree, -1 if the node is not
+        # closed yet
+        self._subtree_ends = array.array ('i')
+        self._text_starts = array.array ('l')
+        self._text_ends = array.array ('l')
+        self._lines = array.array ('i')
+        self._columns = array.array ('i')
+        self._attrs = []
+        self._styles = {}
+        # Results of 'all_text' calls, cleared when the document is modified
+        self._all_texts = {}
+        self._text_buffer_ = ''
+        self._text_chunks = []
+        self._text_length = 0
+        self._current_node = self._add_node (self._tag_id (str (None)), (), None)
+
+    def __getstate__ (self):
+        state = dict (self.__dict__)
+        state['_text_buffer_'] = self._text_buffer ()
+        state['_text_chunks'] = []
+        # Arrays would be pickled as lists of numbers, store them as strings
+        for name in self._ARRAYS:
+            value = state[name]
+            state[name] = (value.typecode, value.tostring (),)
+        # Locations are recreated from their URLs
+        location = self._location
+        state['_location'] = location and location.url ()
+        return state
+
+    def __setstate__ (self, state):
+        for name in self._ARRAYS:
+            typecode, data = state[name]
+            state[name] = array.array (typecode)
+            state[name].fromstring (data)
+        self.__dict__.update (state)
+        url = self._location
+        if url is not None:
+            import location
+            self._location = location.Location (url)
+
+    def _tag_id (self, tag):
+        try:
+            return self._tag_ids[tag]
+        except KeyError:
+            id_ = self._tag_ids[tag] = len (self._tag_names)
+            self._tag_names.append (tag)
+            return id_
+
+    def _add_node (self, tag_id, attrs, input_position):
+        # 'attrs' is a tuple of pairs of strings
+        index = len (self._tags)
+        if self._all_texts:
+            self._all_texts.clear ()
+        parent = prev_sibling = -1
+        if index > 0:
+            parent = self._current_node
+            prev_sibling = self._last_children[parent]
+            if prev_sibling < 0:
+                self._first_children[parent] = index
+            else:
+                self._next_siblings[prev_sibling] = index
+            self._last_children[parent] = index
+        self._tags.append (tag_id)
+        self._parents.append (parent)
+        self._first_children.append (-1)
+        self._last_children.append (-1)
+        self._next_siblings.append (-1)
+        self._prev_siblings.append (prev_sibling)
+        self._subtree_ends.append (-1)
+        self._text_starts.append (0)
+        self._text_ends.append (0)
+        if input_position is None:
+            self._lines.append (-1)
+            self._columns.append (-1)
+        else:
+            self._lines.append (input_position[0])
+            self._columns.append (input_position[1])
+        self._attrs.append (attrs)
+        return index
+
+    def _subtree_end (self, index):
+        end = self._subtree_ends[index]
+        if end < 0:
+            # Not closed yet, all the following nodes belong to its subtree
+            end = len (self._tags)
+        return end
+
+    def _text_buffer (self):
+        if self._text_chunks:
+            self._text_buffer_ = self._text_buffer_ + ''.join (self._text_chunks)
+            self._text_chunks = []
+        return self._text_buffer_
+
+    def _text (self, index):
+        return self._text_buffer ()[self._text_starts[index]:self._text_ends[index]]
+
+    def _iter_tags (self, tags, index):
+        tag_ids = self._tag_ids
+        ids = [tag_ids[t] for t in tags if tag_ids.has_key (t)]
+        if not ids:
+            return
+        node_tags = self._tags
+        for i in xrange (index + 1, self._subtree_end (index)):
+            if node_tags[i] in ids:
+                yield Array_Node (self, i)
+        
+    # Construction
+        
+    def add_tag (self, tag, attrs, input_position):
+        tag = str (string.lower (tag))
+        attrs = tuple ([(str (string.lower (name)), value,) for name, value in attrs])
+        self._current_node = self._add_node (self._tag_id (tag), attrs, input_position)
+
+    def close_tag (self):
+        current = self._current_node
+        if current != 0:
+            self._subtree_ends[current] = len (self._tags)
+            self._current_node = self._parents[current]
+
+    def add_text (self, text):
+        current = self._current_node
+        text = str (text)
+        self._text_chunks.append (text)
+        self._text_length = self._text_length + len (text)
+        last_child = self._last_children[current]
+        if last_child >= 0 and self._tags[last_child] == _TEXT_TAG:
+            # Adjacent texts are stored in a single text node; the text node
+            # is the last node, so the texts are adjacent in the buffer
+            self._text_ends[last_child] = self._text_length
+            self._all_texts.clear ()
+            return
+        # Text nodes get the input position of their parents
+        if self._lines[current] < 0:
+            input_position = None
+        else:
+            input_position = (self._lines[current], self._columns[current],)
+        index = self._add_node (_TEXT_TAG, (), input_position)
+        self._subtree_ends[index] = index + 1
+        self._text_starts[index] = self._text_length - len (text)
+        self._text_ends[index] = self._text_length
+
+    # Walking
+
+    def iter_tags (self, tags):
+        return self._iter_tags (tags, 0)
+
+    def iter_all_nodes (self):
+        return Array_Node (self, 0).iter_subtree ()
+
+
 class Parser (HTMLParser.HTMLParser):
     """(X)HTML parser.
     """
@@ -437,10 +915,16 @@ class Parser (HTMLParser.HTMLParser):
         return self._document
 
     def __init__ (self, **kwargs):
-        """'kwargs' is given to 'Document.__init__'.
+        """'kwargs' is given to the document constructor.
+        The document class is selected by 'config.document_backend'.
         """
         HTMLParser.HTMLParser.__init__ (self)
-        self._document = Document (**kwargs)
+        if config.document_backend == 'arrays':
+            self._document = Array_Document (**kwargs)
+        elif config.document_backend == 'objects':
+            self._document = Document (**kwargs)
+        else:
+            raise Exception ("Unknown document backend", config.document_backend)
 
     def _get_real_pos (self):
         row, col = self.getpos ()
@@ -0,0 +1,741 @@
+### fetcher.py --- Event driven retrieval of many URLs in a single thread
+
+## Copyright (C) 2006 Brailcom, o.p.s.
+##
+## Author: Milan Zamazal <pdm@brailcom.org>
+##
+## COPYRIGHT NOTICE
+##
+## This program is free software; you can redistribute it and/or modify it
+## under the terms of the GNU General Public License as published by the Free
+## Software Foundation; either version 2 of the License, or (at your option)
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+## more details.
+##
+## You should have received a copy of the GNU General Public License along with
+## this program; if not, write to the Free Software Foundation, Inc., 51
+## Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import asyncore
+import httplib
+import Queue
+import random
+import select
+import socket
+import StringIO
+import sys
+import threading
+import time
+import urlparse
+
+from charseq import str
+import connection
+import exception
+
+
+def supports (url):
+    """Return true iff 'url' can be retrieved by 'Fetcher'.
+    """
+    return urlparse.urlparse (url)[0].lower () == 'http' and not connection.proxy_used (url)
+
+def _key (url):
+    parsed_url = urlparse.urlparse (url)
+    return (parsed_url[0].lower (), connection.split_netloc (parsed_url[1])[0].lower (),)
+
+def _host_port (netloc):
+    host = netloc
+    port = 80
+    if ':' in host:
+        host, port = host.rsplit (':', 1)
+        try:
+            port = int (port)
+        except ValueError:
+            raise socket.error ("Invalid port number", port)
+    return host, port
+
+
+Unsupported_Redirection_Error = connection.Unsupported_Redirection_Error
+
+
+class _Resolution (object):
+
+    def __init__ (self, start_time):
+        self.start_time = start_time
+        self.address = None
+        self.error = None
+        self.finished = False
+
+
+class _Resolver (object):
+    # Resolver of host names running in background threads, so that slow name
+    # lookups don't block the event loop
+
+    def __init__ (self, max_threads):
+        self._max_threads = max_threads
+        self._number_of_threads = 0
+        self._queue = Queue.Queue ()
+        self._lock = threading.Lock ()
+
+    def resolve (self, netloc, start_time):
+        # Return '_Resolution' of the host and port given in 'netloc'
+        resolution = _Resolution (start_time)
+        try:
+            host, port = _host_port (netloc)
+        except socket.error, e:
+            resolution.error = e
+            resolution.finished = True
+            return resolution
+        self._queue.put ((resolution, host, port,))
+        self._lock.acquire ()
+        try:
+            if self._number_of_threads < self._max_threads:
+                self._number_of_threads = self._number_of_threads + 1
+                thread = threading.Thread (target=self._run)
+                thread.setDaemon (True)
+                thread.start ()
+        finally:
+            self._lock.release ()
+        return resolution
+
+    def _run (self):
+        while True:
+            resolution, host, port = self._queue.get ()
+            try:
+                family, socket_type, _protocol, _name, address = \
+                    socket.getaddrinfo (host, port, 0, socket.SOCK_STREAM)[0]
+                resolution.address = (family, socket_type, address,)
+            except (socket.error, IndexError), e:
+                resolution.error = e
+            resolution.finished = True
+
+_resolver = _Resolver (8)
+
+
+class Request (object):
+    """HTTP request performed by 'Fetcher'.
+    The response information is available after the request is finished, i.e.
+    after the 'Fetcher.run' call which performed the request returns.
+    """
+
+    def __init__ (self, method, url, headers, file_name, read_body, max_size, deadline):
+        self._method = method
+        self._url = str (url)
+        self._request_headers = headers
+        self._file_name = file_name
+        self._read_body = read_body
+        self._max_size = max_size
+        self._deadline = deadline
+        self._start_time = 0
+        self._attempts = 0
+        self._redirections = 0
+        self._scheduled = False
+        self._sent_time = 0
+        self._latency = None
+        self._finished = False
+        self._error = None
+        self._file = None
+        self._reset ()
+
+    def _reset (self):
+        self._status = None
+        self._headers = None
+        self._body = []
+        self._body_read = False
+        self._size = 0
+        self._truncated = False
+        if self._file is not None:
+            self._file.close ()
+            self._file = None
+
+    def _wants_body (self):
+        read_body = self._read_body
+        if callable (read_body):
+            read_body = read_body (self._headers)
+        self._body_read = bool (read_body)
+        return self._body_read
+    
+    def _add_body (self, data):
+        # Return true iff more data may be added
+        max_size = self._max_size
+        if max_size is not None and self._size + len (data) > max_size:
+            data = data[:max_size-self._size]
+            self._truncated = True
+        self._size = self._size + len (data)
+        if self._file_name is None:
+            self._body.append (data)
+        else:
+            if self._file is None:
+                # Opened only now, so that a file is not created for
+                # redirections and a retried request overwrites data of the
+                # failed attempt
+                self._file = open (self._file_name, 'wb')
+            self._file.write (data)
+        return not self._truncated
+
+    def _finish (self, error):
+        self._finished = True
+        self._error = error
+        try:
+            if error is None and self._file_name is not None and self._file is None:
+                # Empty response
+                open (self._file_name, 'wb').close ()
+            if self._file is not None:
+                self._file.close ()
+                self._file = None
+        except (IOError, OSError), e:
+            self._error = exception.System_Error ("Write to local disk failed", e)
+
+    def url (self):
+        """Return the requested URL, after following redirections.
+        """
+        return self._url
+
+    def finished (self):
+        """Return true iff the request has been finished.
+        """
+        return self._finished
+
+    def error (self):
+        """Return 'exception.System_Error' instance if the request failed.
+        If the request has succeeded, return None.
+        """
+        return self._error
+
+    def status (self):
+        """Return HTTP status code of the response, as an integer.
+        """
+        return self._status
+
+    def headers (self):
+        """Return response headers as an 'httplib.HTTPMessage' instance.
+        """
+        return self._headers
+
+    def body (self):
+        """Return the response body as a string.
+        If the body has been stored to a file or it hasn't been read, return
+        None.
+        """
+        if self._file_name is not None or not self._body_read:
+            return None
+        return ''.join (self._body)
+
+    def truncated (self):
+        """Return true iff the body has been truncated to the maximum size.
+        """
+        return self._truncated
+
+
+class _Channel (asyncore.dispatcher):
+
+    def __init__ (self, fetcher, key, address, socket_map):
+        asyncore.dispatcher.__init__ (self, map=socket_map)
+        self._fetcher = fetcher
+        self.key = key
+        self.request = None
+        self._output = ''
+        self._input = ''
+        self._state = None
+        self._remaining = 0
+        self._keep_alive = False
+        self._discard_body = False
+        self._received = False
+        self._reused = False
+        self._connect_time = self.last_activity = time.time ()
+        family, socket_type, socket_address = address
+        self.create_socket (family, socket_type)
+        try:
+            self.connect (socket_address)
+        except socket.error:
+            asyncore.dispatcher.close (self)
+            raise
+
+    def start (self, request, reused):
+        parsed_url = urlparse.urlparse (request._url)
+        path = urlparse.urlunparse (('', '',) + tuple (parsed_url[2:5]) + ('',)) or '/'
+        host, authorization = connection.split_netloc (parsed_url[1])
+        headers = {'Host': host,
+                   'User-Agent': connection.Connection_Pool._user_agent,
+                   'Accept-Encoding': 'identity',
+                   }
+        if authorization is not None:
+            headers['Authorization'] = authorization
+        headers.update (request._request_headers)
+        lines = ['%s %s HTTP/1.1' % (request._method, path,)]
+        for name, value in headers.items ():
+            lines.append ('%s: %s' % (name, value,))
+        request._reset ()
+        self.request = request
+        self._output = '\r\n'.join (lines) + '\r\n\r\n'
+        self._input = ''
+        self._state = 'headers'
+        self._received = False
+        self._reused = reused
+        self.last_activity = request._sent_time = time.time ()
+
+    # asyncore interface
+
+    def readable (self):
+        return self.request is not None and not self.connecting
+
+    def writable (self):
+        return self.connecting or bool (self._output)
+
+    def handle_connect (self):
+        self.last_activity = time.time ()
+
+    def handle_write (self):
+        sent = self.send (self._output)
+        self._output = self._output[sent:]
+        self.last_activity = time.time ()
+
+    def handle_read (self):
+        data = self.recv (65536)
+        if data:
+            self.last_activity = time.time ()
+            self._received = True
+            self._input = self._input + data
+            self._process ()
+
+    def handle_close (self):
+        if self.request is None:
+            self.close ()
+        elif self._state == 'until_close':
+            self._finish_response (False)
+        else:
+            self._fail (exception.System_Error ("URL could not be retrieved",
+                                                socket.error ("Connection closed by server")),
+                        retry_immediately=(self._reused and not self._received))
+
+    def handle_error (self):
+        e = sys.exc_info ()[1]
+        if self.request is None:
+            self.close ()
+        else:
+            self._fail (exception.System_Error ("URL could not be retrieved", e),
+                        retry_immediately=(self._reused and not self._received))
+
+    def close (self):
+        asyncore.dispatcher.close (self)
+        self._fetcher._forget_channel (self)
+
+    # Response processing
+
+    def check_timeout (self, now, connect_timeout, read_timeout):
+        request = self.request
+        if request is None:
+            return
+        if request._deadline is not None and now >= request._deadline:
+            self._fail (exception.System_Error ("Retrieval time limit exceeded", None))
+        elif self.connecting:
+            if connect_timeout is not None and now - self._connect_time > connect_timeout:
+                self._fail (exception.System_Error ("URL could not be retrieved",
+                                                    socket.timeout ("Connection timed out")))
+        elif read_timeout is not None and now - self.last_activity > read_timeout:
+            self._fail (exception.System_Error ("URL could not be retrieved",
+                                                socket.timeout ("Read timed out")))
+
+    def _fail (self, error, retry_immediately=False):
+        request = self.request
+        self.request = None
+        self.close ()
+        self._fetcher._request_finished (self, request, error, False,
+                                         retry_immediately=retry_immediately,
+                                         connection_failed=not self._received)
+
+    def _finish_response (self, keep_alive):
+        request = self.request
+        self.request = None
+        self._fetcher._request_finished (self, request, None, keep_alive and not self._input)
+
+    def _add_body (self, data):
+        # Return false if the response has been finished
+        if self._discard_body or self.request._add_body (data):
+            return True
+        # The maximum size reached, drop the rest of the response
+        self._finish_response (False)
+        return False
+
+    def _process (self):
+        while self.request is not None:
+            state = self._state
+            if state == 'headers':
+                if not self._process_headers ():
+                    return
+            elif state == 'body':
+                if not self._input:
+                    return
+                data = self._input[:self._remaining]
+                self._input = self._input[len (data):]
+                self._remaining = self._remaining - len (data)
+                if self._add_body (data) and self._remaining == 0:
+                    self._finish_response (self._keep_alive)
+            elif state == 'until_close':
+                data = self._input
+                self._input = ''
+                self._add_body (data)
+                return
+            elif state == 'chunk_data':
+                if not self._input:
+                    return
+                data = self._input[:self._remaining]
+                self._input = self._input[len (data):]
+                self._remaining = self._remaining - len (data)
+                if self._add_body (data) and self._remaining == 0:
+                    self._state = 'chunk_end'
+            else:
+                # Line based states
+                end = self._input.find ('\n')
+                if end < 0:
+                    return
+                line = self._input[:end].strip ()
+                self._input = self._input[end+1:]
+                if state == 'chunk_size':
+                    try:
+                        size = int (line.split (';')[0], 16)
+                    except ValueError:
+                        raise httplib.HTTPException ("Invalid chunk size", line)
+                    if size == 0:
+                        self._state = 'chunk_trailer'
+                    else:
+                        self._remaining = size
+                        self._state = 'chunk_data'
+                elif state == 'chunk_end':
+                    self._state = 'chunk_size'
+                elif state == 'chunk_trailer':
+                    if not line:
+                        self._finish_response (self._keep_alive)
+
+    def _process_headers (self):
+        data = self._input
+        end = data.find ('\r\n\r\n')
+        separator_length = 4
+        lf_end = data.find ('\n\n')
+        if lf_end >= 0 and (end < 0 or lf_end < end):
+            end = lf_end
+            separator_length = 2
+        if end < 0:
+            return False
+        self._input = data[end+separator_length:]
+        lines = data[:end].split ('\n', 1)
+        status_line = lines[0].split (None, 2)
+        try:
+            version = status_line[0]
+            status = int (status_line[1])
+        except (IndexError, ValueError):
+            raise httplib.BadStatusLine (lines[0])
+        if status == 100:
+            # Interim response, the real one follows
+            return True
+        header_text = ''
+        if len (lines) > 1:
+            header_text = lines[1]
+        headers = httplib.HTTPMessage (StringIO.StringIO (header_text + '\r\n\r\n'))
+        request = self.request
+        request._status = status
+        request._headers = headers
+        self._fetcher._response_started (self)
+        self._keep_alive = (version == 'HTTP/1.1' and
+                            (headers.getheader ('connection') or '').lower () != 'close')
+        self._discard_body = self._fetcher._redirection_url (request) is not None
+        if request._method == 'HEAD' or status in (204, 304,):
+            self._finish_response (self._keep_alive)
+            return True
+        if not self._discard_body and not request._wants_body ():
+            # The body is not wanted, drop the connection instead of reading it
+            self._finish_response (False)
+            return True
+        transfer_encoding = (headers.getheader ('transfer-encoding') or '').lower ()
+        content_length = headers.getheader ('content-length')
+        if 'chunked' in transfer_encoding:
+            self._state = 'chunk_size'
+        elif content_length is not None:
+            try:
+                self._remaining = int (content_length)
+            except ValueError:
+                raise httplib.HTTPException ("Invalid content length", content_length)
+            self._state = 'body'
+            if self._remaining <= 0:
+                self._finish_response (self._keep_alive)
+        else:
+            self._state = 'until_close'
+        return True
+
+
+class Fetcher (object):
+    """Event driven performer of many HTTP requests at once in a single thread.
+    Requests are added by the 'add' method and then all of them are performed
+    by the 'run' method, using non-blocking sockets.  Only plain HTTP URLs are
+    supported, see the 'supports' function; requests redirected to other URLs
+    fail with 'Unsupported_Redirection_Error'.  Host names are resolved in
+    background threads.  A fetcher may be used only from a single thread at a
+    time.
+    """
+
+    _redirection_codes = connection.Connection_Pool._redirection_codes
+    _retry_codes = connection.Connection_Pool._retry_codes
+    _poll_interval = 0.2
+    _resolution_poll_interval = 0.005
+
+    def __init__ (self, max_connections=512, max_host_connections=2, max_redirections=5,
+                  circuit_breaker=None, connect_timeout=None, read_timeout=None, retries=0,
+                  retry_backoff=1.0, scheduler=None):
+        """'max_connections' is the maximum number of connections open at once,
+        'max_host_connections' is the maximum number of connections to a single
+        host open at once; it is not used if 'scheduler' is given, the
+        scheduler limits the connections to hosts then.
+        'connect_timeout' limits host name resolution as well.
+        The other arguments have the same meaning as the corresponding
+        arguments of the 'connection.Connection_Pool' constructor.
+        """
+        self._max_connections = max_connections
+        self._max_host_connections = max_host_connections
+        self._max_redirections = max_redirections
+        self._circuit_breaker = circuit_breaker
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._retries = retries
+        self._retry_backoff = retry_backoff
+        self._scheduler = scheduler
+        self._resolutions = {}
+        self._socket_map = {}
+        self._pending = {}
+        self._channels = {}
+        self._number_of_channels = 0
+        self._number_of_unfinished = 0
+
+    def add (self, method, url, headers={}, file_name=None, read_body=True, max_size=None,
+             deadline=None):
+        """Add HTTP request to be performed by the next 'run' call.
+        'method' is the HTTP method name, 'url' is the requested URL and
+        'headers' is a dictionary of additional request headers.
+        If 'file_name' is given, the response body is written into the given
+        file instead of being kept in memory.  If 'read_body' is false, the
+        response body is not retrieved at all; if it is a function, it is
+        called with the response headers and the body is retrieved only if
+        the function returns true.  If 'max_size' is not None, at most
+        'max_size' bytes of the body are retrieved.
+        'deadline', if not None, is the time (as returned by 'time.time') by
+        which the request must be completed.
+        Return the corresponding 'Request' instance.
+        """
+        request = Request (method, url, headers, file_name, read_body, max_size, deadline)
+        if supports (url):
+            self._number_of_unfinished = self._number_of_unfinished + 1
+            self._enqueue (request, time.time ())
+        else:
+            request._finish (exception.System_Error ("Unsupported URL", None, url))
+        return request
+
+    def run (self):
+        """Perform all the added requests and return after all of them finish.
+        """
+        use_poll = hasattr (select, 'poll')
+        while self._number_of_unfinished > 0:
+            self._dispatch ()
+            interval = self._poll_interval
+            for resolution in self._resolutions.values ():
+                if not resolution.finished:
+                    # Check the resolution results often
+                    interval = self._resolution_poll_interval
+                    break
+            if self._socket_map:
+                asyncore.loop (timeout=interval, use_poll=use_poll, map=self._socket_map,
+                               count=1)
+            else:
+                # Only delayed retries or name resolutions are waiting
+                time.sleep (interval)
+            now = time.time ()
+            for channels in self._channels.values ():
+                for c in channels[:]:
+                    c.check_timeout (now, self._connect_timeout, self._read_timeout)
+
+    def request (self, method, url, headers={}, file_name=None, read_body=True, max_size=None,
+                 deadline=None):
+        """Perform single HTTP request and return its finished 'Request'.
+        The arguments are the same as in 'add'.
+        This is a synchronous shorthand for an 'add' call followed by a 'run'
+        call.
+        """
+        request = self.add (method, url, headers=headers, file_name=file_name,
+                            read_body=read_body, max_size=max_size, deadline=deadline)
+        self.run ()
+        return request
+
+    def _enqueue (self, request, start_time):
+        request._start_time = start_time
+        self._pending.setdefault (_key (request._url), []).append (request)
+
+    def _finish (self, request, error):
+        request._finish (error)
+        self._number_of_unfinished = self._number_of_unfinished - 1
+
+    def _retry (self, request, error):
+        if request._attempts >= self._retries:
+            self._finish (request, error)
+            return
+        delay = random.uniform (0, self._retry_backoff * 2 ** request._attempts)
+        request._attempts = request._attempts + 1
+        start_time = time.time () + delay
+        if request._deadline is not None and start_time >= request._deadline:
+            self._finish (request, exception.System_Error ("Retrieval time limit exceeded", None))
+            return
+        self._enqueue (request, start_time)
+
+    def _take_request (self, key, now):
+        # Return the next request to 'key' which may be started now or None
+        requests = self._pending.get (key, [])
+        while True:
+            for request in requests:
+                if request._start_time <= now:
+                    break
+            else:
+                return None
+            requests.remove (request)
+            if not requests:
+                del self._pending[key]
+            host = key[1]
+            if self._circuit_breaker is not None and not self._circuit_breaker.allow (host):
+                self._finish (request, connection.Host_Not_Available_Error (host))
+            elif request._deadline is not None and now >= request._deadline:
+                self._finish (request, exception.System_Error ("Retrieval time limit exceeded", None))
+            else:
+                return request
+
+    def _schedule (self, key, request):
+        # Return true iff 'request' may be started now, otherwise return it to
+        # the pending requests
+        scheduler = self._scheduler
+        if scheduler is None:
+            return True
+        if not scheduler.try_acquire (key[1]):
+            self._pending.setdefault (key, []).insert (0, request)
+            return False
+        request._scheduled = True
+        return True
+
+    def _unschedule (self, key, request, error):
+        if not request._scheduled:
+            return
+        request._scheduled = False
+        if error is None:
+            headers = request._headers
+            self._scheduler.release (key[1], latency=request._latency, status=request._status,
+                                     retry_after=(headers and headers.getheader ('retry-after')))
+        else:
+            self._scheduler.release (key[1])
+
+    def _address (self, key, now):
+        # Return socket address of the host of 'key' or None if it is not
+        # available now
+        resolution = self._resolutions.get (key)
+        if resolution is None:
+            resolution = self._resolutions[key] = _resolver.resolve (key[1], now)
+        if resolution.finished:
+            if resolution.error is None:
+                return resolution.address
+            error = resolution.error
+        elif (self._connect_timeout is not None and
+              now - resolution.start_time > self._connect_timeout):
+            error = socket.timeout ("Host name resolution timed out")
+        else:
+            # Still resolving, just finish requests out of time
+            for request in self._pending.get (key, [])[:]:
+                if request._deadline is not None and now >= request._deadline:
+                    self._pending[key].remove (request)
+                    self._finish (request, exception.System_Error ("Retrieval time limit exceeded", None))
+            if not self._pending.get (key, True):
+                del self._pending[key]
+            return None
+        # Fail the requests, retried requests resolve the name again
+        del self._resolutions[key]
+        if self._circuit_breaker is not None:
+            self._circuit_breaker.failed (key[1])
+        while True:
+            request = self._take_request (key, now)
+            if request is None:
+                break
+            self._retry (request, exception.System_Error ("URL could not be retrieved", error))
+        return None
+    
+    def _dispatch (self):
+        now = time.time ()
+        for key in self._pending.keys ():
+            address = self._address (key, now)
+            if address is None:
+                continue
+            channels = self._channels.setdefault (key, [])
+            while (self._number_of_channels < self._max_connections and
+                   (self._scheduler is not None or len (channels) < self._max_host_connections)):
+                request = self._take_request (key, now)
+                if request is None or not self._schedule (key, request):
+                    break
+                try:
+                    channel = _Channel (self, key, address, self._socket_map)
+                except socket.error, e:
+                    self._unschedule (key, request, e)
+                    if self._circuit_breaker is not None:
+                        self._circuit_breaker.failed (key[1])
+                    self._retry (request, exception.System_Error ("URL could not be retrieved", e))
+                    continue
+                channels.append (channel)
+                self._number_of_channels = self._number_of_channels + 1
+                channel.start (request, False)
+
+    def _forget_channel (self, channel):
+        channels = self._channels.get (channel.key, [])
+        if channel in channels:
+            channels.remove (channel)
+            self._number_of_channels = self._number_of_channels - 1
+
+    def _response_started (self, channel):
+        request = channel.request
+        request._latency = time.time () - request._sent_time
+        if self._circuit_breaker is not None:
+            self._circuit_breaker.succeeded (channel.key[1])
+
+    def _redirection_url (self, request):
+        location = request._headers.getheader ('location')
+        if request._status not in self._redirection_codes or not location:
+            return None
+        return str (urlparse.urljoin (request._url, location))
+
+    def _request_finished (self, channel, request, error, keep_alive, retry_immediately=False,
+                           connection_failed=False):
+        self._unschedule (channel.key, request, error)
+        if error is not None:
+            if retry_immediately:
+                # The server has probably closed the kept alive connection in
+                # the meantime, try again with another one
+                self._enqueue (request, time.time ())
+            else:
+                if connection_failed and self._circuit_breaker is not None:
+                    self._circuit_breaker.failed (channel.key[1])
+                self._retry (request, error)
+        else:
+            url = self._redirection_url (request)
+            if url is not None:
+                if not supports (url):
+                    self._finish (request, Unsupported_Redirection_Error (url))
+                elif request._redirections >= self._max_redirections:
+                    self._finish (request, exception.System_Error ("Too many HTTP redirections", None))
+                else:
+                    request._redirections = request._redirections + 1
+                    request._url = url
+                    if request._status == 303 and request._method != 'HEAD':
+                        request._method = 'GET'
+                    self._enqueue (request, time.time ())
+            elif request._status in self._retry_codes and request._attempts < self._retries:
+                self._retry (request, None)
+            else:
+                self._finish (request, None)
+        if keep_alive:
+            next_request = self._take_request (channel.key, time.time ())
+            if next_request is not None and self._schedule (channel.key, next_request):
+                channel.start (next_request, True)
+                return
+        channel.close ()
@@ -20,48 +20,765 @@
 ## this program; if not, write to the Free Software Foundation, Inc., 51
 ## Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import atexit
 import codecs
+import gzip
 import httplib
-import md5
 import mimetypes
+import mmap
 import os
 import re
+import rfc822
 import string
 import StringIO
+import tempfile
+import threading
+import time
 import urllib
 import urllib2
 import urlparse
+import zlib
 
 from charseq import str
 from charseq import String as S
 from config import logger
+import cache
 import config
+import connection
 import document
 import exception
+import fetcher
 import util
+import warc
 
 
+_CHARSET_PRESCAN_LENGTH = 4096
+"""Number of initial bytes of a page searched for a <meta> charset declaration.
+"""
+
+_BOMS = ((codecs.BOM_UTF8, 'utf-8', len (codecs.BOM_UTF8),),
+         # UTF-16 codecs handle BOMs themselves
+         (codecs.BOM_UTF16_BE, 'utf-16', 0,),
+         (codecs.BOM_UTF16_LE, 'utf-16', 0,),
+         )
+
+_COMMENT_REGEXP = re.compile ('<!--.*?(-->|$)', re.S)
+_META_REGEXP = re.compile ('<meta[ \t\n\r\f/][^>]*>', re.I)
+_META_CHARSET_REGEXP = re.compile ('charset[ \t\n\r\f]*=[ \t\n\r\f]*[\'"]?([-a-z0-9_:.]+)', re.I)
+
+def _known_charset (charset):
+    if not charset:
+        return None
+    try:
+        codecs.lookup (charset)
+    except LookupError: # unknown charset
+        return None
+    return charset
+
+def _sniff_charset (data, transport_charset=None):
+    """Return charset of a page starting with 'data'.
+    'data' is a string containing the initial bytes of the page,
+    'transport_charset' is the charset announced by the server or None.
+    The charset is determined in the order given by the HTML 5 encoding
+    sniffing algorithm: byte order mark, transport charset, <meta>
+    declarations found in 'data'.  Unknown charsets are ignored.
+    Return pair (CHARSET, BOM_LENGTH,) where CHARSET is a charset name or None
+    if no charset could be determined and BOM_LENGTH is the number of initial
+    bytes that should be skipped before decoding the page.
+    """
+    for bom, charset, bom_length in _BOMS:
+        if data[:len (bom)] == bom:
+            return charset, bom_length
+    charset = _known_charset (transport_charset)
+    if charset:
+        return charset, 0
+    data = _COMMENT_REGEXP.sub ('', data)
+    for meta in _META_REGEXP.findall (data):
+        match = _META_CHARSET_REGEXP.search (meta)
+        if match:
+            charset = _known_charset (match.group (1))
+            if charset:
+                return charset, 0
+    return None, 0
+
+
+_shared_objects = {}
+_shared_objects_lock = threading.Lock ()
+
+def _shared (class_, **kwargs):
+    # Return instance of 'class_' constructed with 'kwargs'.  The instance is
+    # shared by all callers as long as 'kwargs' don't change, e.g. after a
+    # configuration change.
+    key = kwargs.items ()
+    key.sort ()
+    key = tuple (key)
+    _shared_objects_lock.acquire ()
+    try:
+        instance_key, instance = _shared_objects.get (class_, (None, None,))
+        if instance is None or instance_key != key:
+            instance = class_ (**kwargs)
+            _shared_objects[class_] = (key, instance,)
+    finally:
+        _shared_objects_lock.release ()
+    return instance
+
+def _circuit_breaker ():
+    return _shared (connection.Circuit_Breaker, threshold=config.circuit_breaker_threshold,
+                    cooldown=config.circuit_breaker_cooldown)
+
+def _host_scheduler ():
+    return _shared (connection.Host_Scheduler, max_connections=config.host_max_connections,
+                    min_interval=config.host_min_interval,
+                    adaptive=config.host_adaptive_concurrency,
+                    max_adaptive_connections=config.host_max_adaptive_connections,
+                    latency_threshold=config.host_latency_threshold)
+
+def _connection_pool ():
+    # Return 'connection.Connection_Pool' corresponding to the current
+    # configuration
+    return _shared (connection.Connection_Pool, circuit_breaker=_circuit_breaker (),
+                    connect_timeout=config.connect_timeout, read_timeout=config.read_timeout,
+                    retries=config.fetch_retries, retry_backoff=config.retry_backoff,
+                    scheduler=_host_scheduler ())
+
+def _make_fetcher ():
+    return fetcher.Fetcher (max_connections=config.fetch_engine_connections,
+                            max_host_connections=config.host_max_connections,
+                            circuit_breaker=_circuit_breaker (),
+                            connect_timeout=config.connect_timeout,
+                            read_timeout=config.read_timeout,
+                            retries=config.fetch_retries, retry_backoff=config.retry_backoff,
+                            scheduler=_host_scheduler ())
+
+def _use_fetcher (url):
+    return config.fetch_engine == 'events' and fetcher.supports (url)
+
+class Offline_Error (exception.System_Error):
+    """Exception raised when network access is requested in the offline mode.
+    See 'config.network_mode'.
+    """
+
+    def __init__ (self, url):
+        exception.System_Error.__init__ (self, "Page not available offline", None, url)
+
+_offline_misses = []
+_offline_misses_known = {}
+_offline_misses_lock = threading.Lock ()
+
+def _record_offline_miss (url):
+    # Add 'url' to '_offline_misses' unless it is already there
+    _offline_misses_lock.acquire ()
+    try:
+        if not _offline_misses_known.has_key (url):
+            _offline_misses_known[url] = True
+            _offline_misses.append (url)
+    finally:
+        _offline_misses_lock.release ()
+
+def _check_online (url):
+    # Raise 'Offline_Error' if 'url' may not be retrieved from the network
+    if config.network_mode == 'offline':
+        _record_offline_miss (url)
+        raise Offline_Error (url)
+
+def offline_misses ():
+    """Return list of URLs requested but not found in the cache so far.
+    URLs are recorded only in the offline mode, see 'config.network_mode'.
+    Each URL is listed only once, in the order of the first request.
+    """
+    _offline_misses_lock.acquire ()
+    try:
+        return _offline_misses[:]
+    finally:
+        _offline_misses_lock.release ()
+
+def _warc_archive ():
+    # Return 'warc.Archive' of 'config.warc_files' or None if there are none
+    if not config.warc_files:
+        return None
+    return _shared (warc.Archive, file_names=tuple (config.warc_files),
+                    index_file_name=config.warc_index_file)
+
+def _archived (url):
+    # Return true iff 'url' is present in 'config.warc_files'
+    archive = _warc_archive ()
+    return archive is not None and archive.contains (url)
+
+def _archived_response (url):
+    # Return 'warc.Response' of 'url' if it is archived, otherwise None
+    archive = _warc_archive ()
+    if archive is None:
+        return None
+    return archive.response (url)
+
+def _archived_headers (url):
+    # Return response headers of archived 'url' or None if it is not archived
+    # or its response is an error
+    response = _archived_response (url)
+    if response is None:
+        return None
+    response.close ()
+    if response.status () >= 400:
+        return None
+    return response.headers ()
+
+class _Archived_Stream (object):
+    # Decoded body of the archived response of 'url', read in place
+
+    def __init__ (self, url):
+        self._url = url
+        self._start ()
+
+    def _start (self):
+        response = _archived_response (self._url)
+        if response is None:
+            raise exception.System_Error ("Page not present in WARC files", None, self._url)
+        self._response = response
+        self._decoder = connection.Content_Decoder (response.headers ().getheader ('content-encoding'))
+        self._buffer = ''
+        self._finished = False
+        self._position = 0
+
+    def read (self, size=-1):
+        data = [self._buffer]
+        length = len (self._buffer)
+        while (size < 0 or length < size) and not self._finished:
+            chunk = self._response.read (65536)
+            if chunk:
+                chunk = self._decoder.decode (chunk)
+            else:
+                chunk = self._decoder.flush ()
+                self._finished = True
+            data.append (chunk)
+            length = length + len (chunk)
+        data = ''.join (data)
+        if size < 0:
+            size = length
+        self._buffer = data[size:]
+        data = data[:size]
+        self._position = self._position + len (data)
+        return data
+
+    def seek (self, position):
+        # Only the decoded data can be skipped, so start again when seeking
+        # back
+        if position < self._position:
+            self.close ()
+            self._start ()
+        while self._position < position:
+            if not self.read (min (position - self._position, 65536)):
+                break
+
+    def close (self):
+        self._response.close ()
+
+def _local_file_name (url):
+    # Return name of the local file of 'url' or None if 'url' is not local,
+    # see 'config.local_sites'
+    url = urlparse.urldefrag (url)[0]
+    parsed_url = urlparse.urlparse (url)
+    if parsed_url[0].lower () == 'file':
+        path = os.path.normpath (urllib.url2pathname (parsed_url[2]))
+    else:
+        for prefix, directory in config.local_sites:
+            # The prefix must end on a path boundary
+            if (url.startswith (prefix) and
+                (prefix[-1:] == '/' or url[len (prefix):len (prefix)+1] in ('', '/', '?',))):
+                break
+        else:
+            return None
+        relative_url = url[len (prefix):].split ('?', 1)[0]
+        # The path is relative to 'directory' even if it starts with a slash
+        relative_path = urllib.url2pathname (relative_url).lstrip ('/' + os.sep)
+        directory = os.path.normpath (directory)
+        path = os.path.normpath (os.path.join (directory, relative_path))
+        if path != directory and not path.startswith (os.path.join (directory, '')):
+            # Don't let '..' escape from the site directory
+            return None
+    if os.path.isdir (path):
+        path = os.path.join (path, config.local_index_file)
+    return path
+
+def _local_headers (file_name):
+    # Return response headers describing local 'file_name' or None if the file
+    # doesn't exist
+    try:
+        stat = os.stat (file_name)
+    except OSError:
+        return None
+    mime_type = mimetypes.guess_type (file_name)[0] or 'application/octet-stream'
+    headers = ('Content-Type: %s\r\nContent-Length: %d\r\nLast-Modified: %s\r\n\r\n' %
+               (mime_type, stat.st_size, rfc822.formatdate (stat.st_mtime),))
+    return httplib.HTTPMessage (StringIO.StringIO (headers))
+
+class _Mapped_File (object):
+    # Read-only stream of a memory mapped file
+
+    def __init__ (self, map_):
+        self._map = map_
+
+    def read (self, size=-1):
+        if size < 0:
+            size = self._map.size () - self._map.tell ()
+        return self._map.read (size)
+
+    def seek (self, position):
+        self._map.seek (position)
+
+    def close (self):
+        self._map.close ()
+
+def _open_local (file_name):
+    # Return read-only stream of local 'file_name', memory mapped if possible
+    try:
+        f = open (file_name, 'rb')
+    except IOError, e:
+        raise exception.System_Error ("File not available", e, file_name)
+    try:
+        try:
+            return _Mapped_File (mmap.mmap (f.fileno (), 0, access=mmap.ACCESS_READ))
+        except (mmap.error, ValueError, EnvironmentError):
+            # Empty files and special files can't be mapped
+            return StringIO.StringIO (f.read ())
+    finally:
+        f.close ()
+
+def _recording ():
+    # In the record mode cached data are never used, everything is retrieved
+    # again and stored to the cache
+    return config.network_mode == 'record'
+    
+def _deadline ():
+    if config.fetch_deadline is None:
+        return None
+    return time.time () + config.fetch_deadline
+
+def _urlopen (url):
+    try:
+        return urllib2.urlopen (url, timeout=config.read_timeout)
+    except urllib2.HTTPError:
+        raise
+    except (IOError, urllib2.URLError), e:
+        raise exception.System_Error ("URL could not be retrieved", e)
+
+class Unsupported_Content_Error (exception.System_Error):
+    """Exception raised when retrieval of a page of a refused type is refused.
+    See 'config.retrieved_mime_types'.
+    """
+
+    def __init__ (self, url, mime_type):
+        exception.System_Error.__init__ (self, "Page type not allowed", None, url, mime_type)
+        
+def _allowed_content (headers):
+    # Return true iff a document with response 'headers' may be retrieved
+    mime_types = config.retrieved_mime_types
+    if mime_types is None or not headers.getheader ('content-type'):
+        return True
+    return headers.gettype () in mime_types
+
+def _store_body (response, headers, file_name, truncated=False):
+    # Write the body read from 'response' to 'file_name', decoding it and
+    # possibly compressing it for storage on the fly.  At most
+    # 'config.max_page_size' bytes of the decoded body are stored.
+    # 'truncated' is true if the body is already known to be incomplete.
+    # Return dictionary of the cache metadata items describing the file.
+    max_size = config.max_page_size
+    size = 0
+    try:
+        decoder = connection.Content_Decoder (headers.getheader ('content-encoding'))
+        if config.cache_compression:
+            compressor = zlib.compressobj (6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            encoding = 'gzip'
+        else:
+            compressor = None
+            encoding = ''
+        try:
+            f = open (file_name, 'wb')
+            try:
+                finished = False
+                while not finished:
+                    data = response.read (65536)
+                    if data:
+                        data = decoder.decode (data)
+                    else:
+                        data = decoder.flush ()
+                        finished = True
+                    if max_size is not None and size + len (data) > max_size:
+                        # Stop reading, the rest of the response is dropped
+                        # by closing it
+                        data = data[:max_size-size]
+                        truncated = finished = True
+                    size = size + len (data)
+                    if compressor is not None:
+                        data = compressor.compress (data)
+                    f.write (data)
+                if compressor is not None:
+                    f.write (compressor.flush ())
+            finally:
+                f.close ()
+        except (IOError, OSError), e:
+            raise exception.System_Error ("Write to local disk failed", e)
+    finally:
+        response.close ()
+    return {'encoding': encoding, 'truncated': util.if_ (truncated, '1', '')}
+    
+def _retrieve (url, file_name, request_headers={}):
+    """Store contents of 'url' to 'file_name'.
+    'request_headers' is a dictionary of additional HTTP request headers.
+    If 'config.http_compression' is true, the server is asked to send the
+    document compressed.  The document is stored decoded, or compressed with
+    gzip if 'config.cache_compression' is true.  Documents longer than
+    'config.max_page_size' are truncated.  If the HTTP response announces a
+    MIME type not present in 'config.retrieved_mime_types', the document is not
+    retrieved and 'Unsupported_Content_Error' is raised.
+    Return triple (HEADERS, MODIFIED, METADATA,) where HEADERS are the response
+    headers, MODIFIED is false iff the server responded the document was not
+    modified, in which case 'file_name' is left untouched, and METADATA is a
+    dictionary of cache metadata items describing the stored file.
+    """
+    _check_online (url)
+    request_headers = dict (request_headers)
+    if config.http_compression:
+        request_headers['Accept-Encoding'] = connection.ACCEPTED_ENCODINGS
+    if _use_fetcher (url):
+        try:
+            return _fetcher_retrieve (url, file_name, request_headers)
+        except fetcher.Unsupported_Redirection_Error, e:
+            # Let the connection pool or urllib2 follow the redirection
+            url = e.url ()
+    pool = _connection_pool ()
+    response = None
+    if pool.supports (url):
+        try:
+            response = pool.request ('GET', url, headers=request_headers, deadline=_deadline ())
+        except connection.Unsupported_Redirection_Error, e:
+            # Let urllib2 follow the redirection
+            url = e.url ()
+    if response is not None:
+        headers = response.headers ()
+        if response.status () == 304:
+            response.close ()
+            return headers, False, {}
+        if not _allowed_content (headers):
+            # Don't download the body
+            response.close ()
+            raise Unsupported_Content_Error (url, headers.gettype ())
+    else:
+        try:
+            response = _urlopen (url)
+        except urllib2.HTTPError, e:
+            response = e
+        headers = response.info ()
+    return headers, True, _store_body (response, headers, file_name)
+
+def _fetcher_retrieve (url, file_name, request_headers):
+    # '_retrieve' using 'fetcher.Fetcher'
+    # The fetcher stores the body as received, decode it afterwards
+    raw_file_name = file_name + '.raw'
+    try:
+        request = _make_fetcher ().request ('GET', url, headers=request_headers,
+                                            file_name=raw_file_name, read_body=_allowed_content,
+                                            max_size=config.max_page_size, deadline=_deadline ())
+        if request.error () is not None:
+            raise request.error ()
+        headers = request.headers ()
+        if request.status () == 304:
+            return headers, False, {}
+        if not _allowed_content (headers):
+            raise Unsupported_Content_Error (url, headers.gettype ())
+        try:
+            response = open (raw_file_name, 'rb')
+        except IOError, e:
+            raise exception.System_Error ("Read from local disk failed", e)
+        return headers, True, _store_body (response, headers, file_name,
+                                           truncated=request.truncated ())
+    finally:
+        if os.path.exists (raw_file_name):
+            os.remove (raw_file_name)
+
+def _freshness_lifetime (headers, stored_time):
+    """Return number of seconds a response with 'headers' may be used.
+    'stored_time' is the time when the response was received.
+    If the response may not be used without revalidation, return 0.
+    """
+    directives = [d.strip ().lower () for d in (headers.getheader ('cache-control') or '').split (',')]
+    if 'no-cache' in directives or 'no-store' in directives:
+        return 0
+    for d in directives:
+        if d[:8] == 'max-age=':
+            try:
+                return int (d[8:])
+            except ValueError:
+                return 0
+    expires = headers.getdate_tz ('expires')
+    if expires is None:
+        return 0
+    date = headers.getdate_tz ('date')
+    if date is None:
+        return rfc822.mktime_tz (expires) - stored_time
+    return rfc822.mktime_tz (expires) - rfc822.mktime_tz (date)
+
+def _head_unsupported (status):
+    # Some servers don't support HEAD requests, the document should be asked
+    # for instead
+    return status >= 400 and status not in (404, 410,)
+
+def _fetch_url_headers (urls):
+    """Return dictionary of response headers of all 'urls'.
+    The headers are retrieved at once using 'fetcher.Fetcher'.  Dictionary
+    values are response headers or None for URLs which can't be retrieved.
+    Only headers are retrieved, not the document bodies, if possible.
+    """
+    headers = {}
+    retrieved_urls = []
+    for url in urls:
+        file_name = _local_file_name (url)
+        if file_name is not None:
+            headers[url] = _local_headers (file_name)
+            continue
+        if _archived (url):
+            headers[url] = _archived_headers (url)
+        else:
+            retrieved_urls.append (url)
+    if config.network_mode == 'offline':
+        for url in retrieved_urls:
+            _record_offline_miss (url)
+            headers[url] = None
+        return headers
+    deadline = _deadline ()
+    fetcher_ = _make_fetcher ()
+    requests = [(url, fetcher_.add ('HEAD', url, deadline=deadline),) for url in retrieved_urls]
+    fetcher_.run ()
+    retried_requests = []
+    for url, request in requests:
+        if request.error () is None and _head_unsupported (request.status ()):
+            retried_requests.append ((url, fetcher_.add ('GET', url, headers={'Range': 'bytes=0-0'},
+                                                         read_body=False, deadline=deadline),))
+    fetcher_.run ()
+    for url, request in requests + retried_requests:
+        error = request.error ()
+        if isinstance (error, fetcher.Unsupported_Redirection_Error):
+            # Let the connection pool or urllib2 follow the redirection
+            try:
+                headers[url] = _retrieved_url_headers (error.url (), deadline)
+            except (urllib2.URLError, exception.System_Error):
+                headers[url] = None
+        elif error is not None or request.status () >= 400:
+            headers[url] = None
+        else:
+            headers[url] = request.headers ()
+    return headers
+
+def _url_headers (url):
+    """Return response headers of 'url' or None if it can't be retrieved.
+    Only headers are retrieved, not the document body, if possible.
+    """
+    file_name = _local_file_name (url)
+    if file_name is not None:
+        return _local_headers (file_name)
+    if _archived (url):
+        return _archived_headers (url)
+    _check_online (url)
+    if _use_fetcher (url):
+        return _fetch_url_headers ((url,))[url]
+    return _retrieved_url_headers (url, _deadline ())
+
+def _retrieved_url_headers (url, deadline):
+    # '_url_headers' using the connection pool or urllib2
+    pool = _connection_pool ()
+    if pool.supports (url):
+        try:
+            return _pool_url_headers (pool, url, deadline)
+        except connection.Unsupported_Redirection_Error, e:
+            # Let urllib2 follow the redirection
+            url = e.url ()
+    try:
+        stream = _urlopen (url)
+    except urllib2.HTTPError:
+        return None
+    headers = stream.info ()
+    stream.close ()
+    return headers
+
+def _pool_url_headers (pool, url, deadline):
+    response = pool.request ('HEAD', url, deadline=deadline)
+    response.close ()
+    if _head_unsupported (response.status ()):
+        # Ask for the first byte of the document instead
+        response = pool.request ('GET', url, headers={'Range': 'bytes=0-0'}, deadline=deadline)
+        if response.status () == 206:
+            response.read ()
+        # Otherwise the server may be sending the whole document, so close the
+        # connection without reading it
+        response.close ()
+    if response.status () >= 400:
+        return None
+    return response.headers ()
+
+
+Cache_Policy = util.Enumeration ("Policy of using cached copies of pages.",
+                                 ('CACHE', "Use the cached copy whenever available.",),
+                                 ('FRESH', "Use the cached copy while it is fresh according to its HTTP headers, "
+                                  "otherwise ask the server whether it has changed.",),
+                                 ('REVALIDATE', "Always ask the server whether the cached copy has changed.",),
+                                 ('RELOAD', "Always retrieve the page again.",),
+                                 )
+
+_VALIDATED_HEADERS = ('date', 'expires', 'cache-control', 'etag', 'last-modified',)
+"""Headers of a not modified response which update the cached headers.
+"""
+
+
+class _URL_Metadata (util.Structure):
+    """Information about a URL shared by all its 'Location' instances.
+    """
+    _attributes = (('headers', "Response headers as 'httplib.HTTPMessage' or None if unknown yet",
+                    None,),
+                   ('mime_type', "MIME type as returned by 'Location.mime_type' or None if unknown yet",
+                    None,),
+                   ('charset', "Charset of the local copy or None if unknown yet", None,),
+                   ('fetched', "True iff the local copy is known to exist", False,),
+                   ('truncated', "True iff the local copy is incomplete, None if unknown yet",
+                    None,),
+                   ('failure_time', "Time of the last failed attempt to retrieve headers or None",
+                    None,),
+                   )
+
+def _url_registry ():
+    # Return 'util.LRU_Cache' of '_URL_Metadata' instances corresponding to the
+    # current configuration
+    return _shared (util.LRU_Cache, size=config.url_registry_size)
+
+def _normalize_url (url):
+    protocol, host, path, parameters, query, _fragment = urlparse.urlparse (url)
+    protocol = protocol.lower ()
+    host = host.lower ()
+    for default_protocol, default_port in (('http', ':80',), ('https', ':443',),):
+        if protocol == default_protocol and host[-len (default_port):] == default_port:
+            host = host[:-len (default_port)]
+    if host and not path:
+        path = '/'
+    return urlparse.urlunparse ((protocol, host, path, parameters, query, '',))
+
+def _url_metadata (url):
+    """Return '_URL_Metadata' instance shared by all locations of 'url'.
+    """
+    return _url_registry ().setdefault (_normalize_url (url), _URL_Metadata ())
+
+        
+def resolve_mime_types (locations):
+    """Determine MIME types of all 'locations' at once.
+    If 'config.fetch_engine' is 'events', the headers of all the locations
+    whose MIME types are unknown are retrieved in a single thread, otherwise
+    the locations are resolved in up to 'config.link_resolution_threads'
+    parallel threads.  In either case the MIME types are remembered, so
+    subsequent 'Location.mime_type' calls return immediately.
+    """
+    if config.fetch_engine != 'events':
+        util.for_each_concurrently (lambda l: l.mime_type (), locations,
+                                    config.link_resolution_threads)
+        return
+    unresolved = {}
+    for l in locations:
+        url = l.url ()
+        if fetcher.supports (url) and l._headers_needed ():
+            unresolved.setdefault (url, []).append (l)
+    if unresolved:
+        def block ():
+            url_headers = _fetch_url_headers (unresolved.keys ())
+            for url, headers in url_headers.items ():
+                for l in unresolved[url]:
+                    l._metadata.headers = l._save_headers (headers)
+        logger.with_action_log ('Retrieving headers of %d URLs' % (len (unresolved),), block)
+    util.for_each_concurrently (lambda l: l.mime_type (), locations, 1)
+
+
+_temporary_file_names = {}
+_temporary_file_names_lock = threading.Lock ()
+
+def _remove_temporary_file (file_name):
+    # Remove 'file_name' unless it has already been removed
+    _temporary_file_names_lock.acquire ()
+    try:
+        if _temporary_file_names.pop (file_name, None) is None:
+            return
+    finally:
+        _temporary_file_names_lock.release ()
+    try:
+        os.remove (file_name)
+    except OSError:
+        pass
+
+def _remove_temporary_files ():
+    # Remove temporary files not removed yet, called on interpreter exit
+    for file_name in _temporary_file_names.keys ():
+        _remove_temporary_file (file_name)
+atexit.register (_remove_temporary_files)
+
+class _Temporary_File (object):
+    """New file in the system temporary directory.
+    The file is removed by the 'remove' method, when the instance is deleted
+    or on interpreter exit, whichever comes first.  Unlike 'Location',
+    instances don't participate in reference cycles, so they are always
+    deleted when no longer referenced.
+    """
+
+    def __init__ (self):
+        fd, self.name = tempfile.mkstemp (prefix='wachecker-')
+        os.close (fd)
+        _temporary_file_names_lock.acquire ()
+        try:
+            _temporary_file_names[self.name] = True
+        finally:
+            _temporary_file_names_lock.release ()
+
+    def remove (self):
+        _remove_temporary_file (self.name)
+
+    def __del__ (self):
+        self.remove ()
+
+        
 class Location (object):
     """Represents location identified by URL.
     """
 
-    def __init__ (self, url, mime_type=None, refresh_cache=util.undefined_argument):
+    def __init__ (self, url, mime_type=None, refresh_cache=util.undefined_argument,
+                  cache_policy=None):
         """Create location identified by 'url' given as a string.
         If 'mime_type' is given, it explicitly specifies the MIME type of the
         location.  It must be either of the form returned by the 'mime_type'
         method or a common MIME type string.
-        If 'refresh_cache' is true, refresh page cache on the first page
-        access.
+        'cache_policy' is one of the 'Cache_Policy' constants determining
+        whether the cached copy of the page may be used on the first page
+        access.  If it is None, 'config.cache_policy' is used.
+        If 'refresh_cache' is given, it overrides 'cache_policy': A true value
+        means 'Cache_Policy.REVALIDATE', a false value means
+        'Cache_Policy.CACHE'.  If neither of the two arguments nor
+        'config.cache_policy' is given, 'config.refresh_cache' is used the same
+        way.
         """
         self._url = str (url)
         self._local_copy_name_ = None
+        self._local_copy_used = False
+        self._uncompressed_copy_ = None
         self._refresh_cache = refresh_cache
+        self._cache_policy_ = cache_policy
         if refresh_cache is util.undefined_argument:
-            self._refresh_cache_needed = config.refresh_cache
-        else:
-            self._refresh_cache_needed = refresh_cache
+            cache_policy = cache_policy or config.cache_policy
+            if cache_policy is None:
+                refresh_cache = config.refresh_cache
+        if refresh_cache is not util.undefined_argument:
+            cache_policy = util.if_ (refresh_cache, Cache_Policy.REVALIDATE, Cache_Policy.CACHE)
+        self._cache_policy = cache_policy
+        self._refresh_cache_needed = (cache_policy != Cache_Policy.CACHE)
         self._mime_type = mime_type and self._parse_mime_type (mime_type)
-        self._headers = None
+        self._metadata = _url_metadata (self._url)
+        self._document = None
+        # Name of the file read in place if the location is local
+        self._file_name = _local_file_name (self._url)
+        # Archived responses are read in place as well
+        self._archived = (self._file_name is None and _archived (self._url))
 
     def _parse_mime_type (self, mime_type):
         default_mime_type = (None, None,)
@@ -74,145 +791,267 @@ class Location (object):
             mime_type = default_mime_type
         return tuple ([str (s) for s in mime_type])
     
+    def _cache (self):
+        return cache.cache ()
+    
+    def _in_place (self):
+        # Return true iff the location is not stored in the cache
+        return self._file_name is not None or self._archived
+    
+    def _stored_headers (self):
+        if _recording () or self._in_place ():
+            return None
+        headers = self._cache ().get (self.url (), 'headers')
+        if headers is None:
+            return None
+        return httplib.HTTPMessage (StringIO.StringIO (headers))
+    
     def _find_headers (self):
         # Cached?
-        cache_file = self._headers_file_name ()
-        try:
-            headers = httplib.HTTPMessage (open (cache_file))
-        except:
-            headers = None
+        headers = self._stored_headers ()
+        # Local or archived?
+        if not headers and self._in_place ():
+            if self._file_name is not None:
+                headers = _local_headers (self._file_name)
+            else:
+                headers = _archived_headers (self.url ())
+            if headers is None:
+                self._metadata.failure_time = time.time ()
+                headers = httplib.HTTPMessage (StringIO.StringIO (''), seekable=0)
+            return headers
         # Retrieve
         if not headers:
             url = self.url ()
             host = str (urlparse.urlparse (url)[1])
             def block ():
                 try:
-                    connection = urllib2.urlopen (url)
-                    headers = connection.info ()
-                    connection.close ()
-                except urllib2.HTTPError:
+                    headers = _url_headers (url)
+                except (urllib2.URLError, exception.System_Error):
+                    headers = None
+                if headers is None:
                     return 'URL could not be fetched', None
                 return None, headers
             headers = logger.with_action_log ('Connecting to %s' % (host,), block)
-        # Save
+        return self._save_headers (headers)
+
+    def _save_headers (self, headers):
         if headers:
+            self._metadata.failure_time = None
             try:
-                open (cache_file, 'w').write (str (headers))
-            except:
+                self._cache ().update (self.url (), {'headers': str (headers)})
+            except exception.System_Error:
                 pass
         else:
+            # Remember the failure for a while, so that other references to
+            # the URL don't try to retrieve it again immediately
+            self._metadata.failure_time = time.time ()
             headers = httplib.HTTPMessage (StringIO.StringIO (''), seekable=0)
         return headers
 
-    def _find_mime_type (self):
+    def _failure_expired (self):
+        # Forget failed headers retrieval if it is too old
+        metadata = self._metadata
+        if (metadata.failure_time is not None and
+            time.time () - metadata.failure_time >= config.negative_cache_ttl):
+            metadata.failure_time = None
+            metadata.headers = None
+            metadata.mime_type = None
+
+    def _known_mime_type (self):
         # Cached?
-        cache_file = self._mime_type_file_name ()
-        try:
-            mime_type_string = str (open (cache_file).read ())
-        except:
+        if _recording () or self._in_place ():
             mime_type_string = None
+        else:
+            mime_type_string = self._cache ().get (self.url (), 'mime_type')
         # Guess
         if not mime_type_string:
-            url = self.url ()
-            mime_type_string = str (mimetypes.guess_type (url)[0])
+            url = self._file_name or self.url ()
+            guessed_mime_type = mimetypes.guess_type (url)[0]
+            mime_type_string = guessed_mime_type and str (guessed_mime_type)
+        return mime_type_string
+
+    def _headers_needed (self):
+        # Return true iff the MIME type can't be determined without retrieving
+        # the headers
+        if self._mime_type is not None or self._in_place ():
+            return False
+        self._failure_expired ()
+        metadata = self._metadata
+        return (metadata.mime_type is None and metadata.headers is None and
+                not self._known_mime_type () and self._stored_headers () is None)
+    
+    def _find_mime_type (self):
+        mime_type_string = self._known_mime_type ()
         # Retrieve        
         if not mime_type_string:
-            mime_type_string = str (self._find_headers ().gettype ())
+            headers = self._headers ()
+            if self._metadata.failure_time is not None:
+                return ''
+            mime_type_string = str (headers.gettype ())
         # Save
         if mime_type_string:
             mime_type = self._parse_mime_type (mime_type_string)
-            try:
-                open (cache_file, 'w').write ('%s/%s' % mime_type)
-            except:
-                pass
+            if not self._in_place ():
+                try:
+                    self._cache ().update (self.url (), {'mime_type': '%s/%s' % mime_type})
+                except exception.System_Error:
+                    pass
         else:
             mime_type = ''    # not None -- to avoid future repeated retrievals
         return mime_type
 
     def _local_copy_name (self):
         if not self._local_copy_name_:
-            hash_ = md5.new (self.url ()).hexdigest ()
-            self._local_copy_name_ = os.path.join (config.cache_directory, hash_)
+            self._local_copy_name_ = self._cache ().content_file_name (self.url ())
         return self._local_copy_name_
+    
+    def _fetch (self, conditional=False):
+        cache_ = self._cache ()
+        url = self.url ()
+        request_headers = {}
+        stored_headers = None
+        if conditional:
+            stored_headers = self._stored_headers ()
+        if stored_headers is not None:
+            etag = stored_headers.getheader ('etag')
+            if etag:
+                request_headers['If-None-Match'] = etag
+            last_modified = stored_headers.getheader ('last-modified')
+            if last_modified:
+                request_headers['If-Modified-Since'] = last_modified
+        def block ():
+            temporary_file_name = cache_.temporary_file_name (url)
+            try:
+                headers, modified, stored_metadata = _retrieve (url, temporary_file_name,
+                                                                request_headers)
+                if modified:
+                    charset = str (headers.getparam ('charset') or '')
+                    stored_metadata.update ({'charset': charset, 'headers': str (headers)})
+                    cache_.commit_content (url, temporary_file_name, stored_metadata)
+            finally:
+                if os.path.exists (temporary_file_name):
+                    os.remove (temporary_file_name)
+            if not modified:
+                for h in _VALIDATED_HEADERS:
+                    value = headers.getheader (h)
+                    if value:
+                        stored_headers[h] = value
+                headers = stored_headers
+                cache_.update (url, {'headers': str (headers)})
+            metadata = self._metadata
+            metadata.headers = headers
+            metadata.fetched = True
+            if modified:
+                metadata.charset = charset
+                metadata.truncated = (stored_metadata['truncated'] == '1')
+                metadata.mime_type = None
+                # The page may have changed, don't use its old parsed form
+                # and uncompressed copy anymore
+                self._document = None
+                self._remove_uncompressed_copy ()
+        if request_headers:
+            message = 'Revalidating page'
+        else:
+            message = 'Fetching page'
+        logger.with_action_log (message, block)
 
-    def _charset_file_name (self):
-        return self._local_copy_name () + '.charset'
-
-    def _mime_type_file_name (self):
-        return self._local_copy_name () + '.mimetype'
-
-    def _headers_file_name (self):
-        return self._local_copy_name () + '.headers'
+    def _fresh (self):
+        headers = self._stored_headers ()
+        if headers is None:
+            return False
+        stored_time = self._cache ().modification_time (self.url (), 'headers')
+        if stored_time is None:
+            return False
+        return time.time () - stored_time < _freshness_lifetime (headers, stored_time)
     
-    def _local_copy_charset (self):
+    def _ensure_local_copy (self):
+        if self._in_place ():
+            # Local files and archived responses are used in place
+            return
+        metadata = self._metadata
+        if (not metadata.fetched and not _recording () and
+            self._cache ().has_content (self.url ())):
+            metadata.fetched = True
+        if not metadata.fetched:
+            self._fetch ()
+        elif self._refresh_cache_needed and config.network_mode == 'online':
+            policy = self._cache_policy
+            if policy == Cache_Policy.RELOAD:
+                self._fetch ()
+            elif policy == Cache_Policy.REVALIDATE or not self._fresh ():
+                self._fetch (conditional=True)
+        self._refresh_cache_needed = False
+        
+    def _open_stored (self):
+        # Return pair (STREAM, METADATA,) of the opened cached copy, STREAM
+        # reads the uncompressed copy
+        if self._file_name is not None:
+            return _open_local (self._file_name), {'charset': '', 'encoding': ''}
+        if self._archived:
+            charset = str (self._headers ().getparam ('charset') or '')
+            return _Archived_Stream (self.url ()), {'charset': charset, 'encoding': ''}
         self._ensure_local_copy ()
-        f = open (self._charset_file_name ())
-        return str (f.read ())
+        cache_ = self._cache ()
+        keys = ('charset', 'encoding',)
+        try:
+            stream, stored_metadata = cache_.open_content (self.url (), keys)
+        except IOError:
+            # The copy may have been just removed from the cache by another
+            # process
+            self._metadata.fetched = False
+            self._ensure_local_copy ()
+            stream, stored_metadata = cache_.open_content (self.url (), keys)
+        if stored_metadata['encoding'] == 'gzip':
+            # Decompressed on the fly while reading
+            stream = gzip.GzipFile (fileobj=stream, mode='rb')
+        return stream, stored_metadata
 
-    def _fetch (self):
-        if not os.path.exists (config.cache_directory):
+    def _uncompressed_copy (self):
+        copy = self._uncompressed_copy_
+        if copy is not None and os.path.exists (copy.name):
+            return copy.name
+        stream, _stored_metadata = self._open_stored ()
+        try:
             try:
-                os.mkdir (config.cache_directory)
-            except OSError, e:
+                copy = _Temporary_File ()
+            except (IOError, OSError), e:
                 raise exception.System_Error ("Write to local disk failed", e)
-        copy_name = self._local_copy_name ()
-        def block ():
-            try:
-                _file_name, headers = urllib.urlretrieve (self.url (), copy_name)
-            except IOError, e:
-                raise exception.System_Error ("URL could not be retrieved", e)
-            charset = str (headers.getparam ('charset') or '')
             try:
-                f = open (self._charset_file_name (), 'w')
-                f.write (charset)
-                f.close ()
-                f = open (self._headers_file_name (), 'w')
-                f.write (str (headers))
-                f.close ()
-            except Exception, e:
+                f = open (copy.name, 'wb')
+                try:
+                    while True:
+                        data = stream.read (65536)
+                        if not data:
+                            break
+                        f.write (data)
+                finally:
+                    f.close ()
+            except (IOError, OSError), e:
+                copy.remove ()
                 raise exception.System_Error ("Write to local disk failed", e)
-        logger.with_action_log ('Fetching page', block)
+        finally:
+            stream.close ()
+        self._uncompressed_copy_ = copy
+        return copy.name
 
-    def _ensure_local_copy (self):
-        if not os.path.exists (self._local_copy_name ()) or self._refresh_cache_needed:
-            self._fetch ()
-            self._refresh_cache_needed = False
+    def _remove_uncompressed_copy (self):
+        copy = self._uncompressed_copy_
+        if copy is not None:
+            self._uncompressed_copy_ = None
+            copy.remove ()
         
     def _open (self):
-        file_name = self.local_copy ()
-        charset = self._local_copy_charset ()
-        stream = open (file_name)
+        self._touch ()
+        stream, stored_metadata = self._open_stored ()
+        # Use the charset stored together with the opened copy, it may differ
+        # from the remembered one if another process has updated the copy
+        charset = self._metadata.charset = str (stored_metadata['charset'] or '')
+        data = stream.read (_CHARSET_PRESCAN_LENGTH)
+        charset, bom_length = _sniff_charset (data, charset)
+        stream.seek (bom_length)
         if charset:
-            try:
-                input_codec = codecs.getreader (charset)
-                stream = input_codec (stream)
-            except LookupError: # unknown charset
-                pass
-        # Check encoding
-        p = document.Parser (location=self)
-        p.feed (stream.read ())
-        charset = util.Variable (charset)
-        def check_charset (node):
-            http_equiv = node.attr ('http-equiv')
-            if http_equiv and http_equiv.lower () == 'content-type':
-                content = node.attr ('content')
-                if content:
-                    match = re.match ('.*; +charset=([-a-z0-9_]+)', content, re.I)
-                    if match:
-                        charset.set (match.group (1))
-                        raise Exception ('charset found')
-        try:
-            p.document ().for_tags (('meta',), check_charset)
-        except:
-            pass
-        # Open the stream again, with proper encoding
-        stream = open (file_name)
-        if charset:
-            try:
-                input_codec = codecs.getreader (charset.get ())
-                stream = input_codec (stream)
-            except LookupError: # unknown charset
-                pass
+            input_codec = codecs.getreader (charset)
+            stream = input_codec (stream)
         return stream
 
     def __str__ (self):
@@ -240,30 +1079,100 @@ class Location (object):
         """Return the MIME type of the location as a pair (MAJOR, MINOR,).
         If the MIME type cannot be determined, return None.
         """
-        if self._mime_type is None:
-            self._mime_type = self._find_mime_type ()
-        return self._mime_type
+        if self._mime_type is not None:
+            return self._mime_type
+        self._failure_expired ()
+        metadata = self._metadata
+        if metadata.mime_type is None:
+            metadata.mime_type = self._find_mime_type ()
+        return metadata.mime_type
 
+    def _headers (self):
+        self._failure_expired ()
+        metadata = self._metadata
+        if metadata.headers is None:
+            metadata.headers = self._find_headers ()
+        return metadata.headers
+    
     def header (self, header):
         """Return the value of 'header', as a string.
         """
-        if self._headers is None:
-            self._headers = self._find_headers ()
-        return str (self._headers.getparam (header))
+        return str (self._headers ().getparam (header))
     
+    def _touch (self):
+        self._ensure_local_copy ()
+        if not self._local_copy_used and not self._in_place ():
+            self._cache ().touch (self.url ())
+            self._local_copy_used = True
+        
     def local_copy (self):
         """Return the name of the local copy file.
+        If the cached copy is stored compressed, return the name of its
+        uncompressed copy in the system temporary directory.
+        If the location is a local file, return the name of the file.  If it
+        is archived, return the name of its temporary copy.
+        Temporary copies are removed by 'release_local_copy', when the
+        location is deleted or on interpreter exit, whichever comes first.
         """
-        self._ensure_local_copy ()
+        if self._file_name is not None:
+            return self._file_name
+        if self._archived:
+            return self._uncompressed_copy ()
+        self._touch ()
+        if self._cache ().get (self.url (), 'encoding') == 'gzip':
+            return self._uncompressed_copy ()
         return self._local_copy_name ()
 
+    def release_local_copy (self):
+        """Remove the temporary copy returned by 'local_copy', if any.
+        Call this method once the file returned by 'local_copy' is no longer
+        needed.  The location remains usable, 'local_copy' makes a new copy
+        when called again.
+        """
+        self._remove_uncompressed_copy ()
+
+    def truncated (self):
+        """Return true iff the local copy is incomplete.
+        Pages longer than 'config.max_page_size' bytes are retrieved only up
+        to that size.  Local files and archived responses are never truncated.
+        """
+        if self._in_place ():
+            return False
+        self._ensure_local_copy ()
+        metadata = self._metadata
+        if metadata.truncated is None:
+            metadata.truncated = (self._cache ().get (self.url (), 'truncated') == '1')
+        return metadata.truncated
+    
     def document (self):
         """Return the location document as a 'document.Document' instance.
+        The document is parsed only on the first call, all subsequent calls
+        return the same instance.  So all the tests run on the location share
+        the single parsed document.
+        """
+        self._ensure_local_copy ()
+        if self._document is None:
+            p = document.Parser (location=self)
+            stream = self._open ()
+            try:
+                # Feed the parser piece by piece, to avoid holding the whole
+                # page text in memory
+                while True:
+                    text = stream.read (65536)
+                    if not text:
+                        break
+                    p.feed (text)
+            finally:
+                stream.close ()
+            self._document = p.document ()
+        return self._document
+
+    def forget_document (self):
+        """Drop the parsed document remembered by the 'document' method.
+        The document is parsed again on the next 'document' call.  This is
+        useful to free memory after all tests on the location were run.
         """
-        p = document.Parser (location=self)
-        doctext = self._open ().read ()
-        p.feed (doctext)
-        return p.document ()
+        self._document = None
 
     def open (self):
         """Return a stream of the location contents.
@@ -290,4 +1199,5 @@ class Location (object):
                 if not url_parsed[5]: # anchor
                     url_parsed[5] = self_parsed[5]
         full_url = urlparse.urlunparse (tuple (url_parsed))
-        return Location (full_url, mime_type=mime_type, refresh_cache=self._refresh_cache)
+        return Location (full_url, mime_type=mime_type, refresh_cache=self._refresh_cache,
+                         cache_policy=self._cache_policy_)
@@ -22,6 +22,7 @@
 
 import StringIO
 import os
+import threading
 
 import util
 
@@ -32,6 +33,7 @@ class Logger (object):
         self._stream = stream
         self._eol = True        # new line just started
         self._stream_position = 0 # number of characters written so far
+        self._lock = threading.RLock ()
         
     def _terpri (self):
         if not self._eol:
@@ -51,11 +53,14 @@ class Logger (object):
             self._stream_position += len (text)
 
     def _write_formatted_message (self, format, message, eol=True):
-        self._terpri ()
-        text = format % (message,)
-        self._write (format % (message,))
-        if eol:
-            self._write (os.linesep)
+        self._lock.acquire ()
+        try:
+            self._terpri ()
+            self._write (format % (message,))
+            if eol:
+                self._write (os.linesep)
+        finally:
+            self._lock.release ()
 
     def log_info (self, message):
         """Log an informational 'message'.
@@ -87,12 +92,23 @@ class Logger (object):
         If MESSAGE is false, log success of the action, otherwise log error.
         Return RETVAL.
         """
-        self._write_formatted_message ('* %s...', message, eol=False)
+        # Actions performed in other threads than the main one are logged
+        # only after they finish, in order not to mix their log lines.  Thread
+        # names may be changed by applications, check the thread class instead.
+        in_main_thread = isinstance (threading.currentThread (), threading._MainThread)
+        if in_main_thread:
+            self._write_formatted_message ('* %s...', message, eol=False)
         def finalize (error, _spos=self._stream_position):
-            if _spos != self._stream_position:
-                self._write_formatted_message ('+ %s...', message, eol=False)
-            self._write ('%s.' % (util.if_ (error, 'ERROR', 'OK'),))
-            self._terpri ()
+            self._lock.acquire ()
+            try:
+                if not in_main_thread:
+                    self._write_formatted_message ('* %s...', message, eol=False)
+                elif _spos != self._stream_position:
+                    self._write_formatted_message ('+ %s...', message, eol=False)
+                self._write ('%s.' % (util.if_ (error, 'ERROR', 'OK'),))
+                self._terpri ()
+            finally:
+                self._lock.release ()
         try:
             result = function ()
         except Exception:
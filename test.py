@@ -207,7 +207,7 @@ class Stylesheet_Test (Test):
 
     def _run (self, document_):
         issues = super (Stylesheet_Test, self)._run (document_)
-        self._style_errors = document_.assign_stylesheets () or []
+        self._style_errors = document_.assign_stylesheets ()
         return issues
 
     def style_errors (self):
@@ -467,9 +467,12 @@ class Link_Watching_Test (Walking_Test):
     Only HTTP links pointing to another document are checked.
     For each of the links, the '_check_link' method is called with the location
     of the link.
+    If '_prefetch_mime_types' is true, MIME types of all the link locations are
+    retrieved in parallel before the '_check_link' calls.
     """
 
     _sensitive_tags = ('a', 'link', 'area',)
+    _prefetch_mime_types = True
     
     def __init__ (self):
         super (Link_Watching_Test, self).__init__ ()
@@ -479,20 +482,39 @@ class Link_Watching_Test (Walking_Test):
         """Return issues related to '_node' at '_location'.
         """
         return []
+
+    def _link_location (self, node):
+        href = node.attr ('href')
+        if not href:
+            return None
+        url = self._base_location.make_location (href, mime_type=node.attr ('type'))
+        if url.protocol () != 'http' or href[0] == '#':
+            return None
+        return url
+
+    def _find_link_locations (self, document):
+        link_locations = {}
+        unique_locations = {}
+        for node in document.iter_tags (self._sensitive_tags):
+            url = self._link_location (node)
+            if url is not None:
+                key = (url.url (), node.attr ('type'),)
+                url = unique_locations.setdefault (key, url)
+                link_locations[node] = url
+        if self._prefetch_mime_types:
+            location.resolve_mime_types (unique_locations.values ())
+        return link_locations
         
     def _check_node (self, node):
         issues = super (Link_Watching_Test, self)._check_node (node)
-        if node.name () in ('a', 'link', 'area',):
-            href = node.attr ('href')
-            if href:
-                url = self._base_location.make_location (href, mime_type=node.attr ('type'))
-                if url.protocol () == 'http' and href[0] != '#':
-                    issues = issues + self._check_link (node, url)
+        url = self._link_locations.get (node)
+        if url is not None:
+            issues = issues + self._check_link (node, url)
         return issues
 
-    def run (self, location):
-        self._last_url_retrieval_time = 0
-        return super (Link_Watching_Test, self).run (location)        
+    def _run (self, document):
+        self._link_locations = self._find_link_locations (document)
+        return super (Link_Watching_Test, self)._run (document)
 
 
 # Test sets
@@ -0,0 +1,190 @@
+### test_fetcher.py --- Tests of the event driven HTTP client
+
+## Copyright (C) 2006 Brailcom, o.p.s.
+##
+## Author: Milan Zamazal <pdm@brailcom.org>
+##
+## COPYRIGHT NOTICE
+##
+## This program is free software; you can redistribute it and/or modify it
+## under the terms of the GNU General Public License as published by the Free
+## Software Foundation; either version 2 of the License, or (at your option)
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+## more details.
+##
+## You should have received a copy of the GNU General Public License along with
+## this program; if not, write to the Free Software Foundation, Inc., 51
+## Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import BaseHTTPServer
+import os
+import SocketServer
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+import connection
+import fetcher
+
+
+_BODY = 'x' * 1000
+
+
+class _Handler (BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message (self, *args):
+        pass
+
+    def _send (self, status, headers, body=''):
+        self.send_response (status)
+        for name, value in headers:
+            self.send_header (name, value)
+        self.end_headers ()
+        if self.command != 'HEAD':
+            self.wfile.write (body)
+
+    def do_GET (self):
+        server = self.server
+        server.requests.append ((self.path, self.client_address,))
+        server.authorizations.append (self.headers.getheader ('authorization'))
+        port = server.server_address[1]
+        if self.path == '/page':
+            self._send (200, (('Content-Type', 'text/html',), ('Content-Length', len (_BODY),),),
+                        _BODY)
+        elif self.path == '/chunked':
+            self._send (200, (('Content-Type', 'text/html',), ('Transfer-Encoding', 'chunked',),),
+                        '5\r\nHello\r\n7\r\n, world\r\n0\r\n\r\n')
+        elif self.path == '/redirect':
+            self._send (302, (('Location', '/page',), ('Content-Length', 0,),))
+        elif self.path == '/secure':
+            self._send (302, (('Location', 'https://127.0.0.1:%d/secret' % (port,),),
+                              ('Content-Length', 0,),))
+        elif self.path == '/busy':
+            self._send (503, (('Retry-After', '1',), ('Content-Length', 0,),))
+        else:
+            self._send (404, (('Content-Length', 0,),))
+
+    do_HEAD = do_GET
+
+
+class _Server (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__ (self):
+        BaseHTTPServer.HTTPServer.__init__ (self, ('127.0.0.1', 0,), _Handler)
+        self.requests = []
+        self.authorizations = []
+
+    def paths (self):
+        return [path for path, _address in self.requests]
+
+    def client_addresses (self):
+        return [address for _path, address in self.requests]
+
+
+class Fetcher_Test (unittest.TestCase):
+
+    def setUp (self):
+        self._server = _Server ()
+        thread = threading.Thread (target=self._server.serve_forever)
+        thread.setDaemon (True)
+        thread.start ()
+        self._base = 'http://127.0.0.1:%d' % (self._server.server_address[1],)
+
+    def tearDown (self):
+        self._server.shutdown ()
+        self._server.server_close ()
+
+    def _fetcher (self, **kwargs):
+        return fetcher.Fetcher (connect_timeout=5, read_timeout=5, **kwargs)
+
+    def test_body (self):
+        request = self._fetcher ().request ('GET', self._base + '/page')
+        self.assertEqual (request.error (), None)
+        self.assertEqual (request.status (), 200)
+        self.assertEqual (request.body (), _BODY)
+        self.failIf (request.truncated ())
+
+    def test_chunked (self):
+        request = self._fetcher ().request ('GET', self._base + '/chunked')
+        self.assertEqual (request.error (), None)
+        self.assertEqual (request.body (), 'Hello, world')
+
+    def test_keep_alive (self):
+        fetcher_ = self._fetcher (max_host_connections=1)
+        requests = [fetcher_.add ('GET', self._base + '/page') for _i in range (5)]
+        fetcher_.run ()
+        for r in requests:
+            self.assertEqual (r.error (), None)
+            self.assertEqual (r.body (), _BODY)
+        self.assertEqual (len (set (self._server.client_addresses ())), 1)
+
+    def test_redirect (self):
+        request = self._fetcher ().request ('GET', self._base + '/redirect')
+        self.assertEqual (request.error (), None)
+        self.assertEqual (request.url (), self._base + '/page')
+        self.assertEqual (request.body (), _BODY)
+
+    def test_unsupported_redirect (self):
+        request = self._fetcher ().request ('GET', self._base + '/secure')
+        error = request.error ()
+        self.failUnless (isinstance (error, fetcher.Unsupported_Redirection_Error))
+        self.failUnless (error.url ().startswith ('https:'))
+        # The request must not have been sent in plain text
+        self.assertEqual (self._server.paths (), ['/secure'])
+
+    def test_truncation (self):
+        request = self._fetcher ().request ('GET', self._base + '/page', max_size=100)
+        self.assertEqual (request.error (), None)
+        self.assertEqual (request.body (), _BODY[:100])
+        self.failUnless (request.truncated ())
+
+    def test_head (self):
+        request = self._fetcher ().request ('HEAD', self._base + '/page')
+        self.assertEqual (request.error (), None)
+        self.assertEqual (request.headers ().getheader ('content-length'), str (len (_BODY)))
+        self.assertEqual (request.body (), None)
+
+    def test_scheduler (self):
+        scheduler = connection.Host_Scheduler (max_connections=1, min_interval=0.2)
+        fetcher_ = self._fetcher (scheduler=scheduler)
+        requests = [fetcher_.add ('GET', self._base + '/page') for _i in range (3)]
+        start = time.time ()
+        fetcher_.run ()
+        for r in requests:
+            self.assertEqual (r.error (), None)
+        self.failUnless (time.time () - start >= 0.4)
+
+    def test_credentials (self):
+        url = self._base.replace ('//', '//user:secret@') + '/page'
+        request = self._fetcher ().request ('GET', url)
+        self.assertEqual (request.error (), None)
+        self.assertEqual (self._server.authorizations, ['Basic dXNlcjpzZWNyZXQ='])
+
+    def test_proxy (self):
+        os.environ['http_proxy'] = 'http://127.0.0.1:1/'
+        try:
+            self.failIf (fetcher.supports (self._base + '/page'))
+            request = self._fetcher ().request ('GET', self._base + '/page')
+            self.failIf (request.error () is None)
+        finally:
+            del os.environ['http_proxy']
+        self.assertEqual (self._server.paths (), [])
+
+    def test_unresolvable_host (self):
+        request = self._fetcher ().request ('GET', 'http://nonexistent.invalid/')
+        self.failIf (request.error () is None)
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -20,9 +20,11 @@
 ## this program; if not, write to the Free Software Foundation, Inc., 51
 ## Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import Queue
 import copy
 import os
 import re
+import threading
 
 import charseq
 
@@ -197,6 +199,45 @@ def read_stream (stream):
     return data
 
 
+# Concurrency
+
+
+def for_each_concurrently (function, sequence, max_threads):
+    """Call 'function' on each element of 'sequence' in parallel threads.
+    At most 'max_threads' threads are run at once.  If 'max_threads' is less
+    than 2, all the calls are performed serially in the current thread.
+    Return after all the calls are finished.  Exceptions raised in the calls
+    are ignored.
+    """
+    if max_threads < 2 or len (sequence) < 2:
+        for x in sequence:
+            try:
+                function (x)
+            except Exception:
+                pass
+        return
+    queue = Queue.Queue ()
+    for x in sequence:
+        queue.put (x)
+    def worker ():
+        while True:
+            try:
+                x = queue.get_nowait ()
+            except Queue.Empty:
+                break
+            try:
+                function (x)
+            except Exception:
+                pass
+    threads = [threading.Thread (target=worker)
+               for _i in range (min (max_threads, len (sequence)))]
+    for t in threads:
+        t.setDaemon (True)
+        t.start ()
+    for t in threads:
+        t.join ()
+
+        
 # Very primitive generic function emulation
 
 
@@ -303,6 +344,98 @@ class Structure (object):
         return result
 
 
+class LRU_Cache (object):
+    """Mapping of limited size.
+    When the number of items reaches the size limit, the least recently used
+    items are discarded.
+    The cache may be used from several threads simultaneously.
+    """
+
+    def __init__ (self, size):
+        """Create cache holding at most 'size' items.
+        """
+        self._size = size
+        self._items = {}
+        # Circular doubly linked list of [PREVIOUS, NEXT, KEY, VALUE] elements,
+        # ordered from the least recently used item to the most recently used
+        # one
+        self._root = root = []
+        root[:] = [root, root, None, None]
+        self._lock = threading.Lock ()
+
+    def _unlink (self, link):
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
+
+    def _append (self, link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+
+    def get (self, key, default=None):
+        """Return value of 'key' or 'default' if 'key' is not present.
+        """
+        self._lock.acquire ()
+        try:
+            link = self._items.get (key)
+            if link is None:
+                return default
+            self._unlink (link)
+            self._append (link)
+            return link[3]
+        finally:
+            self._lock.release ()
+
+    def setdefault (self, key, value):
+        """Return value of 'key', set it to 'value' first if not present.
+        """
+        self._lock.acquire ()
+        try:
+            link = self._items.get (key)
+            if link is None:
+                link = [None, None, key, value]
+                self._items[key] = link
+            else:
+                self._unlink (link)
+            self._append (link)
+            while len (self._items) > self._size:
+                oldest = self._root[1]
+                self._unlink (oldest)
+                del self._items[oldest[2]]
+            return link[3]
+        finally:
+            self._lock.release ()
+
+    def remove (self, key):
+        """Remove 'key' from the cache if present.
+        """
+        self._lock.acquire ()
+        try:
+            link = self._items.get (key)
+            if link is not None:
+                self._unlink (link)
+                del self._items[key]
+        finally:
+            self._lock.release ()
+
+    def clear (self):
+        """Remove all items from the cache.
+        """
+        self._lock.acquire ()
+        try:
+            self._items = {}
+            root = self._root
+            root[:] = [root, root, None, None]
+        finally:
+            self._lock.release ()
+
+    def __len__ (self):
+        return len (self._items)
+    
+
 class Enumeration (object):
     """Object containing only constant attributes.
     The attribute names are specified in the constructor call.
@@ -32,12 +32,15 @@ def validate (location):
     containing the error report.
     """
     def block ():
-        _process_input, stream = os.popen4 ('%s -s %s' % (config.sgmls_program, location.local_copy (),))
-        error_report = ''
-        while True:
-            checker_output = stream.read ()
-            if not checker_output:
-                break
-            error_report = error_report + checker_output
+        try:
+            _process_input, stream = os.popen4 ('%s -s %s' % (config.sgmls_program, location.local_copy (),))
+            error_report = ''
+            while True:
+                checker_output = stream.read ()
+                if not checker_output:
+                    break
+                error_report = error_report + checker_output
+        finally:
+            location.release_local_copy ()
         return error_report, error_report
     return logger.with_action_log ('Checking SGML/XML syntax', block)
@@ -0,0 +1,412 @@
+### warc.py --- Reading pages from WARC archives
+
+## Copyright (C) 2006 Brailcom, o.p.s.
+##
+## Author: Milan Zamazal <pdm@brailcom.org>
+##
+## COPYRIGHT NOTICE
+##
+## This program is free software; you can redistribute it and/or modify it
+## under the terms of the GNU General Public License as published by the Free
+## Software Foundation; either version 2 of the License, or (at your option)
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+## more details.
+##
+## You should have received a copy of the GNU General Public License along with
+## this program; if not, write to the Free Software Foundation, Inc., 51
+## Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import httplib
+import os
+try:
+    import sqlite3
+except ImportError:
+    # Python older than 2.5, WARC files can't be indexed
+    sqlite3 = None
+import StringIO
+import threading
+import urlparse
+import zlib
+
+from charseq import str
+import exception
+
+
+_GZIP_MAGIC = '\x1f\x8b'
+_BLOCK_SIZE = 65536
+# Maximum length of WARC record headers read when indexing
+_MAX_HEADER_LENGTH = 65536
+
+
+class _Member_Stream (object):
+    # Decompressed contents of a single gzip member starting at 'offset'
+
+    def __init__ (self, file_, offset):
+        self._file = file_
+        self._file.seek (offset)
+        self._decompressor = zlib.decompressobj (16 + zlib.MAX_WBITS)
+        self._finished = False
+
+    def read (self, size):
+        data = ''
+        while not data and not self._finished:
+            raw_data = self._file.read (size)
+            if raw_data:
+                data = self._decompressor.decompress (raw_data)
+                if self._decompressor.unused_data:
+                    self._finished = True
+            else:
+                data = self._decompressor.flush ()
+                self._finished = True
+        return data
+
+    def close (self):
+        self._file.close ()
+
+
+class _Reader (object):
+    # Buffered reader of a stream with line reading and position tracking
+
+    def __init__ (self, stream):
+        self._stream = stream
+        self._buffer = ''
+        self.position = 0
+
+    def _fill (self):
+        data = self._stream.read (_BLOCK_SIZE)
+        self._buffer = self._buffer + data
+        return data
+
+    def readline (self):
+        while True:
+            end = self._buffer.find ('\n')
+            if end >= 0:
+                break
+            if not self._fill ():
+                end = len (self._buffer) - 1
+                break
+        line = self._buffer[:end+1]
+        self._buffer = self._buffer[end+1:]
+        self.position = self.position + len (line)
+        return line
+
+    def skip_blank_lines (self):
+        while True:
+            stripped = self._buffer.lstrip ('\r\n')
+            self.position = self.position + len (self._buffer) - len (stripped)
+            self._buffer = stripped
+            if self._buffer or not self._fill ():
+                break
+
+    def read (self, size):
+        if not self._buffer:
+            self._fill ()
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self.position = self.position + len (data)
+        return data
+
+    def close (self):
+        self._stream.close ()
+
+
+def _read_headers (reader):
+    # Return dictionary of header fields with lowercase names and the header
+    # text
+    lines = []
+    while True:
+        line = reader.readline ()
+        if not line or not line.strip ():
+            break
+        lines.append (line)
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split (':', 1)
+            headers[name.strip ().lower ()] = value.strip ()
+    return lines, headers
+
+def _target_uri (warc_headers):
+    uri = warc_headers.get ('warc-target-uri', '')
+    if uri[:1] == '<' and uri[-1:] == '>':
+        uri = uri[1:-1]
+    return str (urlparse.urldefrag (uri)[0])
+
+
+class Response (object):
+    """HTTP response stored in a WARC archive.
+    The interface is the same as of 'connection.Response', except that no
+    network errors can happen.
+    """
+
+    def __init__ (self, url, status, headers, reader, length):
+        self._url = url
+        self._status = status
+        self._headers = headers
+        self._reader = reader
+        self._remaining = length
+        self._chunk_remaining = 0
+        self._chunked = ('chunked' in (headers.getheader ('transfer-encoding') or '').lower ())
+
+    def url (self):
+        """Return the URL of the response.
+        """
+        return self._url
+
+    def status (self):
+        """Return HTTP status code of the response, as an integer.
+        """
+        return self._status
+
+    def headers (self):
+        """Return response headers as an 'httplib.HTTPMessage' instance.
+        """
+        return self._headers
+
+    def _read_raw (self, size):
+        size = min (size, self._remaining)
+        if size <= 0:
+            return ''
+        data = self._reader.read (size)
+        self._remaining = self._remaining - len (data)
+        return data
+
+    def _readline_raw (self):
+        start = self._reader.position
+        line = self._reader.readline ()
+        self._remaining = self._remaining - (self._reader.position - start)
+        return line
+
+    def _read_chunked (self, size):
+        while self._chunk_remaining == 0:
+            line = self._readline_raw ()
+            if not line:
+                return ''
+            try:
+                self._chunk_remaining = int (line.split (';')[0].strip () or '0', 16)
+            except ValueError:
+                return ''
+            if self._chunk_remaining == 0:
+                self._remaining = 0
+                return ''
+        data = self._read_raw (min (size, self._chunk_remaining))
+        self._chunk_remaining = self._chunk_remaining - len (data)
+        if self._chunk_remaining == 0:
+            # CRLF after the chunk data
+            self._readline_raw ()
+        return data
+
+    def read (self, size=None):
+        """Read and return at most 'size' bytes of the response body.
+        If 'size' is None, read the whole remaining body.
+        Transfer encoding is removed, content encoding is retained.
+        """
+        if size is None:
+            data = []
+            while True:
+                d = self.read (_BLOCK_SIZE)
+                if not d:
+                    break
+                data.append (d)
+            return ''.join (data)
+        if self._reader is None:
+            return ''
+        if self._chunked:
+            data = self._read_chunked (size)
+        else:
+            data = self._read_raw (size)
+        if not data:
+            self.close ()
+        return data
+
+    def close (self):
+        """Finish reading the response.
+        """
+        if self._reader is not None:
+            self._reader.close ()
+            self._reader = None
+
+
+class Archive (object):
+    """Set of WARC files providing stored HTTP responses.
+    The files may be uncompressed or compressed record by record with gzip, as
+    usual for '.warc.gz' files.  Responses are found using an index of record
+    offsets, which is built on the first use and updated when any of the files
+    changes.  The index may be stored in a file, so that it needn't be built
+    again in each process.
+    Only 'response' records are used, records of other types are ignored.  If
+    the archive contains several responses of the same URL, the last one is
+    used.
+    The archive may be used from several threads simultaneously.
+    """
+
+    def __init__ (self, file_names, index_file_name=None):
+        """'file_names' is a sequence of WARC file names.
+        'index_file_name' is the name of the SQLite database storing the
+        index; if it is None, the index is kept only in memory.
+        """
+        self._file_names = [os.path.abspath (f) for f in file_names]
+        self._index_file_name = index_file_name or ':memory:'
+        self._db = None
+        self._lock = threading.Lock ()
+
+    def _query (self, query, args=()):
+        self._lock.acquire ()
+        try:
+            if self._db is None:
+                self._open_index ()
+            try:
+                return self._db.execute (query, args).fetchall ()
+            except sqlite3.Error, e:
+                raise exception.System_Error ("WARC index access failed", e)
+        finally:
+            self._lock.release ()
+
+    def _open_index (self):
+        if sqlite3 is None:
+            raise exception.System_Error ("Reading WARC files requires the sqlite3 module", None)
+        try:
+            self._db = sqlite3.connect (self._index_file_name, timeout=60, check_same_thread=False,
+                                        isolation_level=None)
+            self._db.execute ('create table if not exists files '
+                              '(name text primary key, size integer, mtime real)')
+            self._db.execute ('create table if not exists records '
+                              '(url text primary key, file text, offset integer)')
+            for f in self._file_names:
+                self._update_index (f)
+        except sqlite3.Error, e:
+            raise exception.System_Error ("WARC index could not be opened", e)
+
+    def _update_index (self, file_name):
+        try:
+            stat = os.stat (file_name)
+        except OSError, e:
+            raise exception.System_Error ("WARC file not available", e)
+        db = self._db
+        name = unicode (file_name, 'utf-8')
+        if db.execute ('select 1 from files where name = ? and size = ? and mtime = ?',
+                       (name, stat.st_size, stat.st_mtime,)).fetchall ():
+            return
+        db.execute ('begin immediate')
+        try:
+            db.execute ('delete from records where file = ?', (name,))
+            for offset, warc_headers in self._scan (file_name):
+                if warc_headers.get ('warc-type') == 'response':
+                    url = _target_uri (warc_headers)
+                    if url:
+                        db.execute ('insert or replace into records (url, file, offset) values (?, ?, ?)',
+                                    (unicode (url, 'utf-8', 'replace'), name, offset,))
+            db.execute ('insert or replace into files (name, size, mtime) values (?, ?, ?)',
+                        (name, stat.st_size, stat.st_mtime,))
+        except:
+            db.execute ('rollback')
+            raise
+        db.execute ('commit')
+
+    def _scan (self, file_name):
+        # Yield pairs (OFFSET, WARC_HEADERS,) of all records of the file
+        try:
+            f = open (file_name, 'rb')
+        except IOError, e:
+            raise exception.System_Error ("WARC file not available", e)
+        try:
+            try:
+                compressed = (f.read (2) == _GZIP_MAGIC)
+                f.seek (0)
+                if compressed:
+                    for offset, header in self._scan_members (f):
+                        _lines, warc_headers = _read_headers (_Reader (StringIO.StringIO (header)))
+                        yield offset, warc_headers
+                else:
+                    reader = _Reader (f)
+                    while True:
+                        # Records are separated by blank lines
+                        reader.skip_blank_lines ()
+                        offset = reader.position
+                        lines, warc_headers = _read_headers (reader)
+                        if not lines:
+                            break
+                        if not lines[0].startswith ('WARC/'):
+                            raise exception.System_Error ("Invalid WARC record", None, file_name, offset)
+                        yield offset, warc_headers
+                        length = int (warc_headers.get ('content-length', 0))
+                        while length > 0:
+                            data = reader.read (min (length, _BLOCK_SIZE))
+                            if not data:
+                                break
+                            length = length - len (data)
+            except (IOError, ValueError, zlib.error), e:
+                raise exception.System_Error ("Invalid WARC file", e, file_name)
+        finally:
+            f.close ()
+
+    def _scan_members (self, f):
+        # Yield pairs (OFFSET, HEADER,) for all gzip members of 'f', where
+        # HEADER is the initial part of the member contents
+        offset = 0
+        data = ''
+        while True:
+            if not data:
+                data = f.read (_BLOCK_SIZE)
+                if not data:
+                    return
+            start = offset
+            decompressor = zlib.decompressobj (16 + zlib.MAX_WBITS)
+            header = ''
+            while True:
+                decompressed = decompressor.decompress (data)
+                if len (header) < _MAX_HEADER_LENGTH and header.find ('\r\n\r\n') < 0:
+                    header = header + decompressed[:_MAX_HEADER_LENGTH]
+                offset = offset + len (data) - len (decompressor.unused_data)
+                data = decompressor.unused_data
+                if data:
+                    break
+                data = f.read (_BLOCK_SIZE)
+                if not data:
+                    break
+            yield start, header
+
+    def contains (self, url):
+        """Return true iff the archive contains a response of 'url'.
+        """
+        url = str (urlparse.urldefrag (url)[0])
+        return bool (self._query ('select 1 from records where url = ?',
+                                  (unicode (url, 'utf-8', 'replace'),)))
+
+    def response (self, url):
+        """Return 'Response' stored for 'url' or None if there is none.
+        """
+        url = str (urlparse.urldefrag (url)[0])
+        rows = self._query ('select file, offset from records where url = ?',
+                            (unicode (url, 'utf-8', 'replace'),))
+        if not rows:
+            return None
+        file_name, offset = rows[0]
+        try:
+            f = open (file_name.encode ('utf-8'), 'rb')
+            try:
+                compressed = (f.read (2) == _GZIP_MAGIC)
+                if compressed:
+                    stream = _Member_Stream (f, offset)
+                else:
+                    f.seek (offset)
+                    stream = f
+                reader = _Reader (stream)
+                _lines, warc_headers = _read_headers (reader)
+                block_start = reader.position
+                length = int (warc_headers.get ('content-length', 0))
+                status_line = reader.readline ()
+                status = int (status_line.split (None, 2)[1])
+                http_lines, _http_headers = _read_headers (reader)
+                headers = httplib.HTTPMessage (StringIO.StringIO (''.join (http_lines) + '\r\n'))
+            except:
+                f.close ()
+                raise
+        except (IOError, IndexError, ValueError, zlib.error), e:
+            raise exception.System_Error ("Invalid WARC record", e, url)
+        body_length = length - (reader.position - block_start)
+        return Response (url, status, headers, reader, body_length)